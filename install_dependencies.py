@@ -229,8 +229,101 @@ LAVALINK_HOST = "localhost"
 LAVALINK_PORT = 2333
 LAVALINK_PASSWORD = "youshallnotpass"
 
+# Optional: several Lavalink nodes (overrides the single node above)
+# LAVALINK_NODES = [
+#     {"host": "10.0.0.1", "port": 2333, "password": "youshallnotpass"},
+#     {"host": "10.0.0.2", "port": 2333, "password": "youshallnotpass", "name": "backup"},
+# ]
+LAVALINK_NODE_COOLDOWN = 30  # Seconds a failing node is avoided
+LAVALINK_WEBSOCKET = False  # Hold a v4 WebSocket session per node for live load stats
+LAVALINK_RESUME_TIMEOUT = 60  # Seconds Lavalink keeps our session after a disconnect
+
+# Optional: Lavalink HTTP connection pool and timeouts
+LAVALINK_POOL_SIZE = 200  # Max open connections
+LAVALINK_POOL_PER_HOST = 64  # Max open connections per node
+LAVALINK_DNS_CACHE_TTL = 300  # Seconds DNS lookups are cached
+LAVALINK_KEEPALIVE = 60  # Seconds idle connections are kept open
+LAVALINK_CONNECT_TIMEOUT = 3  # Seconds to connect to a node
+LAVALINK_SEARCH_TIMEOUT = 10  # Seconds for a whole /v4/loadtracks request
+LAVALINK_DECODE_TIMEOUT = 3  # Seconds for a whole /v4/decodetrack request
+
+# Optional: /play rate limits and search admission control
+PLAY_USER_RATE = 0.2  # /play per second per user (0 disables)
+PLAY_USER_BURST = 3  # /play burst per user
+PLAY_CHAT_RATE = 1  # /play per second per chat (0 disables)
+PLAY_CHAT_BURST = 10  # /play burst per chat
+SEARCH_MAX_IN_FLIGHT = 32  # Concurrent Lavalink searches
+SEARCH_MAX_WAITING = 64  # Searches allowed to wait for a slot
+SEARCH_WAIT_TIMEOUT = 5  # Seconds a search may wait for a slot
+
+# Optional: Playlist loading
+PLAYLIST_MAX_TRACKS = 1000  # Songs taken from one playlist
+PLAYLIST_CHUNK_SIZE = 50  # Songs enqueued per step
+
+# Optional: /queue pages
+QUEUE_PAGE_SIZE = 10  # Songs per /queue page
+
+# Optional: Assistant accounts that join voice chats (Pyrogram session strings)
+ASSISTANT_SESSIONS = []  # Empty: the main client joins calls itself
+ASSISTANT_VNODES = 64  # Hash ring points per assistant
+ASSISTANT_LOAD_FACTOR = 1.25  # Max calls per assistant relative to average
+
+# Optional: Status message edit pacing
+EDIT_CHAT_INTERVAL = 1.5  # Min seconds between edits in one chat
+EDIT_GLOBAL_RATE = 20  # Max edits per second overall
+
+# Optional: Prometheus metrics endpoint
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464  # 0 disables /metrics; worker K serves on METRICS_PORT + 1 + K
+
+# Optional: Worker processes, each owning a share of chats and assistant accounts
+WORKERS = 0  # 0 runs everything in one process; needs ASSISTANT_SESSIONS >= WORKERS
+WORKER_SOCKET_DIR = None  # Unix sockets to the workers (None: system temp dir)
+WORKER_CALL_TIMEOUT = 30  # Seconds to wait for a worker to answer a command
+
 # Optional: Owner ID for admin commands
 OWNER_ID = 0  # Your Telegram user ID
+
+# Optional: Search result cache
+SEARCH_CACHE_SIZE = 512  # Max cached searches (0 disables)
+SEARCH_CACHE_TTL = 600  # Seconds a cached search stays valid
+DECODE_CACHE_SIZE = 2048  # Max memoized /v4/decodetrack results
+
+# Optional: Playback retry policy
+PLAY_MAX_FAILURES = 5  # Failed songs in a row before playback pauses
+PLAY_RETRY_BASE_DELAY = 0.5  # First retry delay in seconds (doubles each failure)
+PLAY_RETRY_MAX_DELAY = 10  # Retry delay cap in seconds
+PLAYER_IDLE_TIMEOUT = 300  # Seconds before an idle chat player is dropped
+
+# Optional: Prefetch of upcoming songs
+PREFETCH_COUNT = 2  # Upcoming songs resolved ahead per chat
+PREFETCH_CACHE_SIZE = 256  # Max resolved stream URLs kept
+PREFETCH_TTL = 300  # Seconds a resolved URL is trusted (capped by its expire=)
+PREFETCH_EXTRACT = True  # Pre-extract direct audio URLs with yt-dlp
+PREFETCH_WARM = False  # Also fetch the first 64 KB of each resolved URL
+
+# Optional: On-disk audio cache for hot tracks
+AUDIO_CACHE_DIR = None  # e.g. "audio_cache" (None disables); split per worker
+AUDIO_CACHE_MAX_BYTES = 2 * 2 ** 30  # Total size cap, least recently played evicted first
+AUDIO_CACHE_MAX_DURATION = 900  # Seconds; longer tracks are never cached
+AUDIO_CACHE_FILLS = 2  # Downloads running at once
+AUDIO_CACHE_PCM = False  # Store raw 48 kHz PCM (~10x larger) so repeats skip decoding; needs ffmpeg and PyTgCalls
+FRAME_PIPELINE = False  # Push cached PCM to calls as frames, no ffmpeg per call; needs numpy, py-tgcalls 2
+FRAME_RING_FRAMES = 50  # 20 ms frames buffered per call
+FRAME_BROADCAST = False  # Decode each track once for all chats starting it together; needs ffmpeg
+FRAME_SHARE_FRAMES = 500  # Frames a shared decode keeps; chats may join in the first half
+
+# Optional: Queue persistence across restarts
+STATE_JOURNAL = "queue_state.jsonl"  # Journal file (None disables)
+STATE_COMPACT_EVERY = 10000  # Journal lines before compaction
+
+# Optional: Startup warm-up, done before commands are accepted
+HOT_TRACKS_FILE = "hot_tracks.json"  # Most played tracks, saved on shutdown (None disables)
+HOT_TRACKS_SIZE = 200  # Tracks kept in it
+HOT_TRACKS_PREFETCH = 10  # Hottest tracks whose stream URLs are resolved at startup
+WARMUP_CONNECTIONS = 4  # Keep-alive connections opened to each Lavalink node
+WARMUP_QUERIES = ["lofi hip hop", "top songs"]  # Searches sent to warm Lavalink up
+WARMUP_TIMEOUT = 5  # Seconds the warm-up may delay startup
 """
     
     try:
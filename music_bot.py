@@ -4,177 +4,2762 @@ Telegram Music Bot with Lavalink - FIXED HANDLER VERSION
 Handlers registered AFTER client starts (like your working play.py)
 """
 
+import time
+
+STARTED = time.monotonic()
+
 import os
 import sys
+import argparse
 import asyncio
+import bisect
+import hashlib
+import importlib.util
+import json
 import logging
-from typing import Dict, Optional
-from pyrogram import Client, filters
-from pyrogram.types import Message
-from pyrogram.handlers import MessageHandler
+import math
+import random
+import shutil
+import signal
+import tempfile
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+# Setup logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+logging.getLogger("pyrogram.session").setLevel(logging.WARNING)
+logging.getLogger("pyrogram.connection").setLevel(logging.WARNING)
+
+logger.info("="*60)
+logger.info("MUSIC BOT STARTING")
+logger.info("="*60)
+
+# Import config
+try:
+    from config import API_ID, API_HASH, LAVALINK_HOST, LAVALINK_PORT, LAVALINK_PASSWORD
+    logger.info(f"✓ Config loaded - API_ID: {API_ID}")
+    
+    try:
+        from config import BOT_TOKEN
+        USE_USERBOT = False
+        logger.info(f"✓ Using BOT mode")
+    except ImportError:
+        BOT_TOKEN = None
+        USE_USERBOT = True
+        logger.info("✓ Using USERBOT mode")
+except ImportError as e:
+    logger.error(f"❌ Config error: {e}")
+    sys.exit(1)
+
+import config as _config
+
+
+def config_value(name, default):
+    """Optional config.py setting with a default"""
+    return getattr(_config, name, default)
+
+
+SEARCH_CACHE_SIZE = config_value("SEARCH_CACHE_SIZE", 512)
+SEARCH_CACHE_TTL = config_value("SEARCH_CACHE_TTL", 600)
+DECODE_CACHE_SIZE = config_value("DECODE_CACHE_SIZE", 2048)
+PLAY_MAX_FAILURES = config_value("PLAY_MAX_FAILURES", 5)
+PLAY_RETRY_BASE_DELAY = config_value("PLAY_RETRY_BASE_DELAY", 0.5)
+PLAY_RETRY_MAX_DELAY = config_value("PLAY_RETRY_MAX_DELAY", 10)
+PLAYER_IDLE_TIMEOUT = config_value("PLAYER_IDLE_TIMEOUT", 300)
+PREFETCH_COUNT = config_value("PREFETCH_COUNT", 2)
+PREFETCH_CACHE_SIZE = config_value("PREFETCH_CACHE_SIZE", 256)
+PREFETCH_TTL = config_value("PREFETCH_TTL", 300)
+PREFETCH_EXTRACT = config_value("PREFETCH_EXTRACT", True)
+PREFETCH_WARM = config_value("PREFETCH_WARM", False)
+AUDIO_CACHE_DIR = config_value("AUDIO_CACHE_DIR", None)
+AUDIO_CACHE_MAX_BYTES = config_value("AUDIO_CACHE_MAX_BYTES", 2 * 2 ** 30)
+AUDIO_CACHE_MAX_DURATION = config_value("AUDIO_CACHE_MAX_DURATION", 900)
+AUDIO_CACHE_FILLS = config_value("AUDIO_CACHE_FILLS", 2)
+AUDIO_CACHE_PCM = config_value("AUDIO_CACHE_PCM", False)
+FRAME_PIPELINE = config_value("FRAME_PIPELINE", False)
+FRAME_MS = 20
+FRAME_RING_FRAMES = config_value("FRAME_RING_FRAMES", 50)
+FRAME_BROADCAST = config_value("FRAME_BROADCAST", False)
+FRAME_SHARE_FRAMES = config_value("FRAME_SHARE_FRAMES", 500)
+STATE_JOURNAL = config_value("STATE_JOURNAL", "queue_state.jsonl")
+STATE_COMPACT_EVERY = config_value("STATE_COMPACT_EVERY", 10000)
+HOT_TRACKS_FILE = config_value("HOT_TRACKS_FILE", "hot_tracks.json")
+HOT_TRACKS_SIZE = config_value("HOT_TRACKS_SIZE", 200)
+HOT_TRACKS_PREFETCH = config_value("HOT_TRACKS_PREFETCH", 10)
+WARMUP_CONNECTIONS = config_value("WARMUP_CONNECTIONS", 4)
+WARMUP_QUERIES = config_value("WARMUP_QUERIES", ["lofi hip hop", "top songs"])
+WARMUP_TIMEOUT = config_value("WARMUP_TIMEOUT", 5)
+LAVALINK_NODES = config_value("LAVALINK_NODES", None) or [
+    {"host": LAVALINK_HOST, "port": LAVALINK_PORT, "password": LAVALINK_PASSWORD}
+]
+LAVALINK_NODE_COOLDOWN = config_value("LAVALINK_NODE_COOLDOWN", 30)
+LAVALINK_WEBSOCKET = config_value("LAVALINK_WEBSOCKET", False)
+LAVALINK_RESUME_TIMEOUT = config_value("LAVALINK_RESUME_TIMEOUT", 60)
+LAVALINK_POOL_SIZE = config_value("LAVALINK_POOL_SIZE", 200)
+LAVALINK_POOL_PER_HOST = config_value("LAVALINK_POOL_PER_HOST", 64)
+LAVALINK_DNS_CACHE_TTL = config_value("LAVALINK_DNS_CACHE_TTL", 300)
+LAVALINK_KEEPALIVE = config_value("LAVALINK_KEEPALIVE", 60)
+LAVALINK_CONNECT_TIMEOUT = config_value("LAVALINK_CONNECT_TIMEOUT", 3)
+LAVALINK_SEARCH_TIMEOUT = config_value("LAVALINK_SEARCH_TIMEOUT", 10)
+LAVALINK_DECODE_TIMEOUT = config_value("LAVALINK_DECODE_TIMEOUT", 3)
+PLAY_USER_RATE = config_value("PLAY_USER_RATE", 0.2)
+PLAY_USER_BURST = config_value("PLAY_USER_BURST", 3)
+PLAY_CHAT_RATE = config_value("PLAY_CHAT_RATE", 1)
+PLAY_CHAT_BURST = config_value("PLAY_CHAT_BURST", 10)
+SEARCH_MAX_IN_FLIGHT = config_value("SEARCH_MAX_IN_FLIGHT", 32)
+SEARCH_MAX_WAITING = config_value("SEARCH_MAX_WAITING", 64)
+SEARCH_WAIT_TIMEOUT = config_value("SEARCH_WAIT_TIMEOUT", 5)
+PLAYLIST_MAX_TRACKS = config_value("PLAYLIST_MAX_TRACKS", 1000)
+PLAYLIST_CHUNK_SIZE = config_value("PLAYLIST_CHUNK_SIZE", 50)
+QUEUE_PAGE_SIZE = config_value("QUEUE_PAGE_SIZE", 10)
+EDIT_CHAT_INTERVAL = config_value("EDIT_CHAT_INTERVAL", 1.5)
+EDIT_GLOBAL_RATE = config_value("EDIT_GLOBAL_RATE", 20)
+ASSISTANT_SESSIONS = config_value("ASSISTANT_SESSIONS", [])
+ASSISTANT_VNODES = config_value("ASSISTANT_VNODES", 64)
+ASSISTANT_LOAD_FACTOR = config_value("ASSISTANT_LOAD_FACTOR", 1.25)
+METRICS_HOST = config_value("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = config_value("METRICS_PORT", 9464)
+WORKERS = config_value("WORKERS", 0)
+WORKER_SOCKET_DIR = config_value("WORKER_SOCKET_DIR", None) or tempfile.gettempdir()
+WORKER_CALL_TIMEOUT = config_value("WORKER_CALL_TIMEOUT", 30)
+
+# The front process starts each worker as `music_bot.py --worker K --workers N`
+_parser = argparse.ArgumentParser()
+_parser.add_argument("--workers", type=int, default=WORKERS)
+_parser.add_argument("--worker", type=int, default=None)
+_args, _ = _parser.parse_known_args()
+WORKERS = _args.workers
+WORKER_INDEX = _args.worker
+
+if WORKER_INDEX is not None:
+    # Every worker keeps its own journal and serves its own metrics
+    if STATE_JOURNAL:
+        STATE_JOURNAL = f"{STATE_JOURNAL}.worker{WORKER_INDEX}"
+    if HOT_TRACKS_FILE:
+        HOT_TRACKS_FILE = f"{HOT_TRACKS_FILE}.worker{WORKER_INDEX}"
+    if METRICS_PORT:
+        METRICS_PORT += 1 + WORKER_INDEX
+    if AUDIO_CACHE_DIR:
+        AUDIO_CACHE_DIR = os.path.join(AUDIO_CACHE_DIR, f"worker{WORKER_INDEX}")
+        AUDIO_CACHE_MAX_BYTES //= WORKERS
+
+# Detect TgCalls library
+TGCALLS_LIB = None
+try:
+    with open(".tgcalls_lib", "r") as f:
+        TGCALLS_LIB = f.read().strip()
+except:
+    pass
+
+TGCALLS_LIB = "ntgcalls" if TGCALLS_LIB == "ntgcalls" else "pytgcalls"
+
+# The TgCalls backend is slow to import, so load_call_engine() fills these in later
+NTgCalls = PyTgCalls = MediaStream = None
+AudioQuality = Device = ExternalMedia = None
+_call_engine_loaded = False
+
+
+def load_call_engine():
+    """Import the TgCalls backend picked by .tgcalls_lib"""
+    global NTgCalls, PyTgCalls, MediaStream, AudioQuality, Device, ExternalMedia, _call_engine_loaded
+    if _call_engine_loaded:
+        return
+    started = time.monotonic()
+    if TGCALLS_LIB == "ntgcalls":
+        try:
+            from ntgcalls import NTgCalls
+        except ImportError:
+            logger.error("❌ NTgCalls not found!")
+            raise SystemExit(1)
+    else:
+        # Imported on the loop thread: py-tgcalls calls asyncio.get_event_loop() at import
+        try:
+            from pytgcalls import PyTgCalls
+            from pytgcalls.types import MediaStream
+        except ImportError:
+            logger.error("❌ No TgCalls library found!")
+            raise SystemExit(1)
+        try:
+            from pytgcalls.types import AudioQuality, Device, ExternalMedia
+        except ImportError:
+            # py-tgcalls < 2.0 cannot take pushed frames
+            ExternalMedia = None
+    _call_engine_loaded = True
+    logger.info(f"✓ Using {'NTgCalls' if TGCALLS_LIB == 'ntgcalls' else 'PyTgCalls'} ({(time.monotonic() - started) * 1000:.0f} ms)")
+
+# Pyrogram and aiohttp are imported by load_client_libraries() once main() or worker_main() runs
+Client = filters = None
+FloodWait = MessageNotModified = None
+CallbackQuery = InlineKeyboardButton = InlineKeyboardMarkup = Message = None
+CallbackQueryHandler = MessageHandler = None
+aiohttp = None
+
+
+def load_client_libraries():
+    """Import Pyrogram and aiohttp"""
+    global Client, filters, FloodWait, MessageNotModified
+    global CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
+    global CallbackQueryHandler, MessageHandler, aiohttp
+    started = time.monotonic()
+    try:
+        import aiohttp
+    except ImportError:
+        logger.error("❌ aiohttp not found!")
+        raise SystemExit(1)
+    from pyrogram import Client, filters
+    from pyrogram.errors import FloodWait, MessageNotModified
+    from pyrogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
+    from pyrogram.handlers import CallbackQueryHandler, MessageHandler
+    logger.info(f"✓ Loaded Pyrogram and aiohttp ({(time.monotonic() - started) * 1000:.0f} ms)")
+
+# yt-dlp is imported on first use (or warmed after startup), since it is slow to load
+YT_DLP_AVAILABLE = importlib.util.find_spec("yt_dlp") is not None
+if not YT_DLP_AVAILABLE:
+    logger.info("yt-dlp not found, prefetch will not pre-extract stream URLs")
+
+np = None
+if FRAME_PIPELINE:
+    try:
+        import numpy as np
+    except ImportError:
+        logger.warning("numpy not found, FRAME_PIPELINE is disabled")
+        FRAME_PIPELINE = False
+
+if FRAME_BROADCAST and not (FRAME_PIPELINE and shutil.which("ffmpeg")):
+    logger.warning("FRAME_BROADCAST needs FRAME_PIPELINE and ffmpeg, it is disabled")
+    FRAME_BROADCAST = False
+
+# The bot client, built by build_clients() in the front process only
+app = None
+
+
+class Assistant:
+    """An account that joins voice chats, with its own call engine"""
+    
+    # Raw PCM the call engine sends, so a cached .pcm file needs no decoding
+    PCM_RATE = 48000
+    PCM_CHANNELS = 2
+    
+    def __init__(self, name: str, client, owns_client: bool):
+        self.name = name
+        self.client = client
+        self.owns_client = owns_client
+        self.calls = None  # created in start(), once the backend is loaded
+        self.chats = set()
+    
+    @property
+    def load(self) -> int:
+        return len(self.chats)
+    
+    async def start(self):
+        load_call_engine()
+        self.calls = NTgCalls() if TGCALLS_LIB == "ntgcalls" else PyTgCalls(self.client)
+        if TGCALLS_LIB != "ntgcalls":
+            await self.calls.start()
+        if self.owns_client:
+            await self.client.start()
+            logger.info(f"✓ Assistant {self.name} started")
+    
+    async def stop(self):
+        if self.owns_client:
+            await self.client.stop()
+    
+    @classmethod
+    def _media(cls, stream_url: str):
+        if stream_url.endswith(".pcm"):
+            # Tell ffmpeg the input is already in the output format, so it only copies
+            return MediaStream(
+                stream_url,
+                ffmpeg_parameters=f"-f s16le -ar {cls.PCM_RATE} -ac {cls.PCM_CHANNELS}"
+            )
+        return MediaStream(stream_url)
+    
+    @property
+    def _play_api(self) -> bool:
+        # py-tgcalls 2.x replaced join_group_call/change_stream/leave_group_call with play/leave_call
+        return TGCALLS_LIB != "ntgcalls" and hasattr(self.calls, "play")
+    
+    @property
+    def supports_frames(self) -> bool:
+        return self._play_api and ExternalMedia is not None
+    
+    async def start_frames(self, chat_id: int):
+        """Switch chat's call (joining it if needed) to frames pushed with send_frame"""
+        await self.calls.play(chat_id, MediaStream(ExternalMedia.AUDIO, AudioQuality.HIGH))
+    
+    async def send_frame(self, chat_id: int, frame: memoryview):
+        # The binding takes bytes, so this is the one copy a frame makes
+        await self.calls.send_frame(chat_id, Device.MICROPHONE, bytes(frame))
+    
+    async def join(self, chat_id: int, stream_url: str):
+        if TGCALLS_LIB == "ntgcalls":
+            await self.calls.join_call(chat_id, stream_url, stream_type="audio")
+        elif self._play_api:
+            await self.calls.play(chat_id, self._media(stream_url))
+        else:
+            await self.calls.join_group_call(chat_id, self._media(stream_url))
+    
+    async def change_stream(self, chat_id: int, stream_url: str):
+        if TGCALLS_LIB == "ntgcalls":
+            await self.calls.change_stream(chat_id, stream_url, stream_type="audio")
+        elif self._play_api:
+            await self.calls.play(chat_id, self._media(stream_url))
+        else:
+            await self.calls.change_stream(chat_id, self._media(stream_url))
+    
+    async def leave(self, chat_id: int):
+        if TGCALLS_LIB == "ntgcalls" or self._play_api:
+            await self.calls.leave_call(chat_id)
+        else:
+            await self.calls.leave_group_call(chat_id)
+    
+    async def pause(self, chat_id: int):
+        if TGCALLS_LIB == "ntgcalls" or self._play_api:
+            await self.calls.pause(chat_id)
+        else:
+            await self.calls.pause_stream(chat_id)
+    
+    async def resume(self, chat_id: int):
+        if TGCALLS_LIB == "ntgcalls" or self._play_api:
+            await self.calls.resume(chat_id)
+        else:
+            await self.calls.resume_stream(chat_id)
+    
+    def on_stream_end(self, callback):
+        """Call callback(chat_id) on the running loop when a stream finishes"""
+        loop = asyncio.get_running_loop()
+        
+        if TGCALLS_LIB == "ntgcalls":
+            # NTgCalls calls back from its own native thread
+            self.calls.on_stream_end(lambda chat_id, *args: loop.call_soon_threadsafe(callback, chat_id))
+        elif hasattr(self.calls, "on_stream_end"):
+            # py-tgcalls < 2.0
+            @self.calls.on_stream_end()
+            async def stream_end_handler(client, update):
+                callback(update.chat_id)
+        else:
+            from pytgcalls import filters as call_filters
+            
+            @self.calls.on_update(call_filters.stream_end())
+            async def stream_end_handler(client, update):
+                callback(update.chat_id)
+
+
+class AssistantPool:
+    """Assigns chats to assistants by consistent hashing with bounded load"""
+    
+    def __init__(self, assistants: List[Assistant], vnodes: int = 64, load_factor: float = 1.25):
+        self.assistants = assistants
+        self.load_factor = load_factor
+        self._ring = sorted(
+            ((self._hash(f"{a.name}#{i}"), a) for a in assistants for i in range(vnodes)),
+            key=lambda point: point[0]
+        )
+        self._points = [point[0] for point in self._ring]
+        self._assigned: Dict[int, Assistant] = {}
+    
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+    
+    def assign(self, chat_id: int) -> Assistant:
+        assistant = self._assigned.get(chat_id)
+        if assistant is not None:
+            return assistant
+        # Walk clockwise from the chat's point to the first assistant under the cap
+        cap = math.ceil((len(self._assigned) + 1) * self.load_factor / len(self.assistants))
+        start = bisect.bisect(self._points, self._hash(str(chat_id)))
+        for i in range(len(self._ring)):
+            assistant = self._ring[(start + i) % len(self._ring)][1]
+            if assistant.load < cap:
+                break
+        assistant.chats.add(chat_id)
+        self._assigned[chat_id] = assistant
+        return assistant
+    
+    def release(self, chat_id: int):
+        assistant = self._assigned.pop(chat_id, None)
+        if assistant is not None:
+            assistant.chats.discard(chat_id)
+    
+    async def start(self):
+        await asyncio.gather(*(assistant.start() for assistant in self.assistants))
+    
+    async def stop(self):
+        await asyncio.gather(*(assistant.stop() for assistant in self.assistants), return_exceptions=True)
+    
+    def stats(self) -> dict:
+        return {assistant.name: assistant.load for assistant in self.assistants}
+
+
+# Filled in by build_clients()
+assistants = AssistantPool([])
+
+
+def build_clients():
+    """Create the bot client and the assistant accounts this process drives"""
+    global app, assistants
+    if WORKER_INDEX is None:
+        # Initialize client WITHOUT plugins parameter
+        if USE_USERBOT:
+            app = Client("music_userbot", api_id=API_ID, api_hash=API_HASH)
+        else:
+            app = Client("music_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+    
+    if WORKERS and WORKER_INDEX is None:
+        # The front process only routes commands; the workers own the voice chats
+        return
+    
+    # Initialize TgCalls on every assistant account; without any, the main client joins calls itself
+    assistant_sessions = list(enumerate(ASSISTANT_SESSIONS, 1))
+    if WORKER_INDEX is not None:
+        # Each worker drives its own slice of the assistant accounts
+        assistant_sessions = assistant_sessions[WORKER_INDEX::WORKERS]
+    
+    if assistant_sessions:
+        assistants = AssistantPool([
+            Assistant(
+                f"assistant_{i}",
+                Client(f"music_assistant_{i}", api_id=API_ID, api_hash=API_HASH, session_string=session),
+                owns_client=True
+            )
+            for i, session in assistant_sessions
+        ], ASSISTANT_VNODES, ASSISTANT_LOAD_FACTOR)
+    else:
+        assistants = AssistantPool([Assistant("main", app, owns_client=False)])
+
+
+def format_duration(ms: int) -> str:
+    """Milliseconds as m:ss (or h:mm:ss)"""
+    seconds = ms // 1000
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+
+class QueuedTrack:
+    """A queued song"""
+    
+    __slots__ = ("title", "author", "duration", "track", "uri", "identifier", "requester")
+    
+    def __init__(self, title, author, duration, track, uri=None, identifier=None, requester=None):
+        self.title = title
+        self.author = author
+        self.duration = duration
+        self.track = track
+        self.uri = uri
+        self.identifier = identifier
+        self.requester = requester
+    
+    def to_dict(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+    
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**data)
+    
+    @classmethod
+    def from_lavalink(cls, track: dict, requester=None):
+        info = track.get("info", {})
+        return cls(
+            title=info.get("title", "Unknown"),
+            author=info.get("author", "Unknown"),
+            duration=info.get("length", 0),
+            track=track.get("encoded"),
+            uri=info.get("uri"),
+            identifier=info.get("identifier"),
+            requester=requester
+        )
+
+
+class ChatQueue:
+    """Per-chat song queue with O(1) pop from the front"""
+    
+    __slots__ = ("_tracks", "total_duration", "pages")
+    
+    def __init__(self, tracks: Iterable[QueuedTrack] = ()):
+        self._tracks: deque = deque()
+        self.total_duration = 0
+        # Rendered /queue pages, dropped on every change
+        self.pages: Dict[int, tuple] = {}
+        self.extend(tracks)
+    
+    def __len__(self):
+        return len(self._tracks)
+    
+    def __bool__(self):
+        return bool(self._tracks)
+    
+    def __iter__(self):
+        return iter(self._tracks)
+    
+    def __getitem__(self, index: int) -> QueuedTrack:
+        return self._tracks[index]
+    
+    def append(self, track: QueuedTrack):
+        self._tracks.append(track)
+        self.total_duration += track.duration
+        self.pages.clear()
+    
+    def extend(self, tracks: Iterable[QueuedTrack]):
+        for track in tracks:
+            self.append(track)
+    
+    def pop(self) -> Optional[QueuedTrack]:
+        if not self._tracks:
+            return None
+        track = self._tracks.popleft()
+        self.total_duration -= track.duration
+        self.pages.clear()
+        return track
+    
+    def peek(self, count: int, start: int = 0) -> List[QueuedTrack]:
+        return list(islice(self._tracks, start, start + count))
+    
+    def remove(self, index: int) -> QueuedTrack:
+        track = self._tracks[index]
+        del self._tracks[index]
+        self.total_duration -= track.duration
+        self.pages.clear()
+        return track
+    
+    def move(self, src: int, dst: int):
+        track = self._tracks[src]
+        del self._tracks[src]
+        self._tracks.insert(dst, track)
+        self.pages.clear()
+    
+    def shuffle(self):
+        tracks = list(self._tracks)
+        random.shuffle(tracks)
+        self._tracks = deque(tracks)
+        self.pages.clear()
+    
+    def clear(self):
+        self._tracks.clear()
+        self.total_duration = 0
+        self.pages.clear()
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _render_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels) + "}"
+
+
+class Counter:
+    """Monotonic counter, optionally labelled"""
+    
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[tuple, float] = {}
+    
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_render_labels(labels)} {value}")
+        return lines
+
+
+class Gauge:
+    """Gauge read from a callback at scrape time"""
+    
+    TYPE = "gauge"
+    
+    def __init__(self, name: str, help: str, read):
+        self.name = name
+        self.help = help
+        self.read = read  # -> iterable of (labels dict, value)
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.TYPE}"]
+        for labels, value in self.read():
+            lines.append(f"{self.name}{_render_labels(tuple(sorted(labels.items())))} {value}")
+        return lines
+
+
+class CounterReader(Gauge):
+    """Counter read from a callback at scrape time, for totals kept by another object"""
+    
+    TYPE = "counter"
+
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally labelled"""
+    
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._series: Dict[tuple, list] = {}
+    
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+    
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in self._series.items():
+            for bound, count in zip(self.buckets, series):
+                lines.append(f"{self.name}_bucket{_render_labels(labels + (('le', bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_render_labels(labels + (('le', '+Inf'),))} {series[-2]}")
+            lines.append(f"{self.name}_count{_render_labels(labels)} {series[-2]}")
+            lines.append(f"{self.name}_sum{_render_labels(labels)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Metrics exposed in Prometheus text format"""
+    
+    def __init__(self):
+        self._metrics = []
+        self._runner = None
+    
+    def counter(self, name: str, help: str) -> Counter:
+        metric = Counter(name, help)
+        self._metrics.append(metric)
+        return metric
+    
+    def gauge(self, name: str, help: str, read) -> Gauge:
+        metric = Gauge(name, help, read)
+        self._metrics.append(metric)
+        return metric
+    
+    def counter_reader(self, name: str, help: str, read) -> CounterReader:
+        metric = CounterReader(name, help, read)
+        self._metrics.append(metric)
+        return metric
+    
+    def histogram(self, name: str, help: str, buckets=Histogram.DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, help, buckets)
+        self._metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Metric {metric.name} error: {e}")
+        return "\n".join(lines) + "\n"
+    
+    async def start(self, host: str, port: int):
+        from aiohttp import web
+        
+        async def handle(request):
+            return web.Response(text=self.render(), content_type="text/plain", charset="utf-8")
+        
+        server = web.Application()
+        server.router.add_get("/metrics", handle)
+        self._runner = web.AppRunner(server, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logger.info(f"✓ Metrics on http://{host}:{port}/metrics")
+    
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.histogram("musicbot_handler_seconds", "Command handler latency")
+LAVALINK_SECONDS = metrics.histogram("musicbot_lavalink_request_seconds", "Lavalink request latency")
+FIRST_AUDIO_SECONDS = metrics.histogram("musicbot_time_to_first_audio_seconds", "Time from /play to audio starting")
+TRANSITION_SECONDS = metrics.histogram("musicbot_transition_gap_seconds", "Gap between a stream ending and the next starting")
+ERRORS = metrics.counter("musicbot_errors_total", "Errors by kind")
+REJECTED = metrics.counter("musicbot_rejected_total", "/play requests turned away by admission control")
+
+
+class SearchCache:
+    """LRU cache of /v4/loadtracks results with a TTL"""
+    
+    def __init__(self, max_size: int = 512, ttl: float = 600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def identifier(query: str) -> str:
+        """Lavalink identifier for a query (URL or ytsearch:)"""
+        query = query.strip()
+        if query.startswith("http"):
+            return query
+        return f"ytsearch:{' '.join(query.split())}"
+    
+    @staticmethod
+    def key(identifier: str) -> str:
+        if identifier.startswith("ytsearch:"):
+            return identifier.lower()
+        return identifier
+    
+    def get(self, identifier: str):
+        key = self.key(identifier)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, result = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return result
+    
+    def set(self, identifier: str, result: dict):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        key = self.key(identifier)
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def clear(self):
+        self._entries.clear()
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens/second up to capacity"""
+    
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+    
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def take(self) -> float:
+        """Take one token; returns 0 on success, else seconds until one is available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+    
+    def refund(self):
+        """Give back a token taken for a request that was rejected elsewhere"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class RateLimiter:
+    """Token bucket per key, keeping at most max_keys buckets"""
+    
+    def __init__(self, rate: float, burst: float, max_keys: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+    
+    def check(self, key: int) -> float:
+        if self.rate <= 0:
+            return 0.0
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            # The least recently seen bucket has had the longest to refill
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take()
+    
+    def refund(self, key: int):
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            bucket.refund()
+
+
+class LavalinkBusy(Exception):
+    """Too many Lavalink searches in flight"""
+
+
+class SearchAdmission:
+    """Caps in-flight Lavalink searches with a bounded wait queue"""
+    
+    def __init__(self, max_in_flight: int, max_waiting: int, wait_timeout: float):
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self.waiting = 0
+        self.rejected = 0
+    
+    async def __aenter__(self):
+        if self._slots.locked():
+            if self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise LavalinkBusy("search queue full")
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise LavalinkBusy("timed out waiting for a search slot")
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        return self
+    
+    async def __aexit__(self, *exc):
+        self._slots.release()
+
+
+class EditScheduler:
+    """Coalesces message edits and paces them per chat and globally"""
+    
+    def __init__(self, chat_interval: float, global_rate: float):
+        self.chat_interval = chat_interval
+        self._global = TokenBucket(global_rate, max(1, global_rate))
+        # (chat_id, message_id) -> (message, latest text); re-editing keeps its place in line
+        self._pending: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self._chat_ready: Dict[int, float] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.coalesced = 0
+        self.flood_waits = 0
+    
+    def edit(self, message, text: str, reply_markup=None):
+        """Schedule message to show text; superseded edits are dropped"""
+        key = (message.chat.id, message.id)
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = (message, text, reply_markup)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wakeup.set()
+    
+    def _next_ready(self, now: float):
+        for key in self._pending:
+            if self._chat_ready.get(key[0], 0) <= now:
+                return key
+        return None
+    
+    async def _run(self):
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            
+            now = time.monotonic()
+            key = self._next_ready(now)
+            if key is None:
+                delay = min(self._chat_ready[k[0]] for k in self._pending) - now
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            wait = self._global.take()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            
+            message, text, reply_markup = self._pending.pop(key)
+            self._chat_ready[key[0]] = now + self.chat_interval
+            try:
+                await message.edit_text(text, reply_markup=reply_markup)
+                self.sent += 1
+            except FloodWait as e:
+                # Defer this chat instead of sleeping inside the call
+                self.flood_waits += 1
+                self._chat_ready[key[0]] = time.monotonic() + e.value
+                self._pending.setdefault(key, (message, text, reply_markup))
+                logger.warning(f"⚠ FloodWait {e.value}s editing in {key[0]}, deferred")
+            except MessageNotModified:
+                pass
+            except Exception as e:
+                logger.warning(f"Edit error in {key[0]}: {e}")
+            
+            if len(self._chat_ready) > 10000:
+                now = time.monotonic()
+                self._chat_ready = {c: t for c, t in self._chat_ready.items() if t > now}
+    
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "flood_waits": self.flood_waits,
+        }
+
+
+class LavalinkNode:
+    """One Lavalink server and its recent health"""
+    
+    def __init__(self, host, port, password, name=None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.name = name or f"{host}:{port}"
+        self.base_url = f"http://{host}:{port}"
+        self.headers = {"Authorization": password, "Content-Type": "application/json"}
+        self.session_id: Optional[str] = None
+        self.load = 0.0  # Lavalink's own CPU load from its stats event
+        self.players = 0
+        self.playing_players = 0
+        self.stats_at = 0.0
+        self.latency = 0.0  # EWMA, seconds
+        self.error_rate = 0.0  # EWMA of failed requests
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+    
+    @property
+    def available(self) -> bool:
+        return self.down_until <= time.monotonic()
+    
+    @property
+    def score(self) -> float:
+        """Lower is better"""
+        score = (self.latency or 0.05) * (1 + self.in_flight) * (1 + 10 * self.error_rate)
+        # Stats are pushed every minute; older ones mean the socket is gone
+        if time.monotonic() - self.stats_at < 120:
+            score *= 1 + self.load
+        return score
+    
+    def apply_stats(self, stats: dict):
+        self.load = stats.get("cpu", {}).get("lavalinkLoad", 0.0)
+        self.players = stats.get("players", 0)
+        self.playing_players = stats.get("playingPlayers", 0)
+        self.stats_at = time.monotonic()
+    
+    def record_success(self, latency: float):
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.latency = latency if not self.latency else 0.8 * self.latency + 0.2 * latency
+        self.error_rate *= 0.8
+    
+    def record_failure(self):
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.error_rate = 0.8 * self.error_rate + 0.2
+        if self.consecutive_failures >= 3:
+            self.down_until = time.monotonic() + LAVALINK_NODE_COOLDOWN
+            logger.warning(f"⚠ Lavalink node {self.name} marked down for {LAVALINK_NODE_COOLDOWN}s")
+    
+    def stats(self) -> dict:
+        return {
+            "latency_ms": round(self.latency * 1000, 1),
+            "error_rate": round(self.error_rate, 3),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "failures": self.failures,
+            "available": self.available,
+            "session": self.session_id,
+            "load": round(self.load, 3),
+            "players": self.players,
+        }
+
+
+class PoolStats:
+    """Connection pool counters fed by aiohttp trace hooks"""
+    
+    def __init__(self):
+        self.queued = 0
+        self.waiting = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.created = 0
+        self.reused = 0
+    
+    def trace_config(self) -> "aiohttp.TraceConfig":
+        trace = aiohttp.TraceConfig()
+        
+        async def queued_start(session, ctx, params):
+            ctx.queued_at = time.monotonic()
+            self.queued += 1
+            self.waiting += 1
+        
+        async def queued_end(session, ctx, params):
+            waited = time.monotonic() - ctx.queued_at
+            self.waiting -= 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+        
+        async def created(session, ctx, params):
+            self.created += 1
+        
+        async def reused(session, ctx, params):
+            self.reused += 1
+        
+        trace.on_connection_queued_start.append(queued_start)
+        trace.on_connection_queued_end.append(queued_end)
+        trace.on_connection_create_end.append(created)
+        trace.on_connection_reuseconn.append(reused)
+        return trace
+    
+    def stats(self) -> dict:
+        return {
+            "waiting": self.waiting,
+            "queued": self.queued,
+            "avg_wait_ms": round(self.wait_time / self.queued * 1000, 1) if self.queued else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "created": self.created,
+            "reused": self.reused,
+        }
+
+
+class LavaLinkClient:
+    """Lavalink client over a pool of nodes"""
+    
+    def __init__(self, nodes: List[dict]):
+        self.nodes = [LavalinkNode(**node) for node in nodes]
+        self.session = None
+        self.pool_stats = PoolStats()
+        self.admission = SearchAdmission(SEARCH_MAX_IN_FLIGHT, SEARCH_MAX_WAITING, SEARCH_WAIT_TIMEOUT)
+        # Requests currently on the wire, shared by identical callers
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.coalesced = 0
+        self.search_cache = SearchCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+        # encoded track -> decoded track info (decoding is deterministic)
+        self.decode_cache: "OrderedDict[str, dict]" = OrderedDict()
+        self._sockets: List[asyncio.Task] = []
+    
+    async def initialize(self):
+        connector = aiohttp.TCPConnector(
+            limit=LAVALINK_POOL_SIZE,
+            limit_per_host=LAVALINK_POOL_PER_HOST,
+            ttl_dns_cache=LAVALINK_DNS_CACHE_TTL,
+            keepalive_timeout=LAVALINK_KEEPALIVE
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=LAVALINK_SEARCH_TIMEOUT, connect=LAVALINK_CONNECT_TIMEOUT),
+            trace_configs=[self.pool_stats.trace_config()]
+        )
+        if LAVALINK_WEBSOCKET:
+            self._sockets = [asyncio.create_task(self._run_socket(node)) for node in self.nodes]
+        logger.info(f"✓ Lavalink session initialized ({len(self.nodes)} nodes)")
+    
+    async def close(self):
+        for task in self._sockets:
+            task.cancel()
+        await asyncio.gather(*self._sockets, return_exceptions=True)
+        if self.session:
+            await self.session.close()
+    
+    async def _run_socket(self, node: LavalinkNode):
+        """Hold node's v4 WebSocket session open, resuming it after drops"""
+        delay = 1
+        while True:
+            headers = {
+                "Authorization": node.password,
+                # Lavalink wants a numeric client id; any stable one will do
+                "User-Id": str(API_ID),
+                "Client-Name": "TelegramMusicBot/1.0",
+            }
+            if node.session_id:
+                headers["Session-Id"] = node.session_id
+            try:
+                async with self.session.ws_connect(
+                    f"ws://{node.host}:{node.port}/v4/websocket", headers=headers, heartbeat=30
+                ) as ws:
+                    delay = 1
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            break
+                        await self._on_socket_message(node, json.loads(msg.data))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Lavalink node {node.name} socket error: {e!r}")
+            logger.warning(f"⚠ Lavalink node {node.name} socket closed, reconnecting in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+    
+    async def _on_socket_message(self, node: LavalinkNode, message: dict):
+        op = message.get("op")
+        if op == "ready":
+            node.session_id = message["sessionId"]
+            logger.info(
+                f"✓ Lavalink {node.name} session {node.session_id}"
+                f"{' resumed' if message.get('resumed') else ''}"
+            )
+            try:
+                # Keep the session alive across our own reconnects
+                async with self.session.patch(
+                    f"{node.base_url}/v4/sessions/{node.session_id}",
+                    json={"resuming": True, "timeout": LAVALINK_RESUME_TIMEOUT},
+                    headers=node.headers
+                ) as resp:
+                    resp.raise_for_status()
+            except Exception as e:
+                logger.warning(f"Lavalink node {node.name} resume setup error: {e!r}")
+        elif op == "stats":
+            node.apply_stats(message)
+        elif op in ("playerUpdate", "event"):
+            logger.debug(f"Lavalink {node.name} {op}: {message}")
+    
+    def _pick_node(self, exclude) -> Optional[LavalinkNode]:
+        candidates = [n for n in self.nodes if n not in exclude]
+        if not candidates:
+            return None
+        # Fall back to nodes in cooldown rather than failing outright
+        healthy = [n for n in candidates if n.available] or candidates
+        return min(healthy, key=lambda n: n.score)
+    
+    async def _get_json(self, path: str, params: dict, timeout: float):
+        """GET from the healthiest node, failing over to the others"""
+        timeout = aiohttp.ClientTimeout(total=timeout, connect=LAVALINK_CONNECT_TIMEOUT)
+        tried = []
+        while True:
+            node = self._pick_node(tried)
+            if node is None:
+                return None
+            tried.append(node)
+            node.in_flight += 1
+            started = time.monotonic()
+            try:
+                async with self.session.get(
+                    f"{node.base_url}{path}", params=params, headers=node.headers, timeout=timeout
+                ) as resp:
+                    if resp.status >= 500:
+                        raise RuntimeError(f"HTTP {resp.status}")
+                    data = await resp.json() if resp.status == 200 else None
+                elapsed = time.monotonic() - started
+                node.record_success(elapsed)
+                LAVALINK_SECONDS.observe(elapsed, op=path.rsplit("/", 1)[-1], node=node.name)
+                return data
+            except Exception as e:
+                node.record_failure()
+                ERRORS.inc(kind="lavalink")
+                logger.warning(f"Lavalink node {node.name} error on {path}: {e!r}")
+            finally:
+                node.in_flight -= 1
+    
+    async def preconnect(self, per_node: int) -> int:
+        """Open per_node pooled keep-alive connections to every available node; returns how many"""
+        async def ping(node: LavalinkNode) -> bool:
+            try:
+                async with self.session.get(f"{node.base_url}/version", headers=node.headers) as resp:
+                    await resp.read()
+                    return resp.status == 200
+            except Exception as e:
+                logger.debug(f"Lavalink {node.name} preconnect error: {e!r}")
+                return False
+        
+        # Concurrent requests each need their own connection, which then stays in the pool
+        results = await asyncio.gather(
+            *(ping(node) for node in self.nodes if node.available for _ in range(per_node))
+        )
+        return sum(results)
+    
+    async def check_nodes(self) -> int:
+        """Probe /version on every node; returns how many answered"""
+        async def check(node: LavalinkNode) -> bool:
+            started = time.monotonic()
+            try:
+                async with self.session.get(f"{node.base_url}/version", headers=node.headers) as resp:
+                    if resp.status == 200:
+                        node.record_success(time.monotonic() - started)
+                        logger.info(f"✓ Lavalink {node.name}: {await resp.text()}")
+                        return True
+                    logger.error(f"❌ Lavalink {node.name}: HTTP {resp.status}")
+            except Exception as e:
+                logger.error(f"❌ Lavalink {node.name} error: {e}")
+            node.record_failure()
+            node.down_until = time.monotonic() + LAVALINK_NODE_COOLDOWN
+            return False
+        
+        results = await asyncio.gather(*(check(node) for node in self.nodes))
+        return sum(results)
+    
+    def stats(self) -> dict:
+        return {
+            "nodes": {node.name: node.stats() for node in self.nodes},
+            "pool": self.pool_stats.stats(),
+            "in_flight": len(self._in_flight),
+            "coalesced": self.coalesced,
+            "search_waiting": self.admission.waiting,
+            "search_rejected": self.admission.rejected,
+        }
+    
+    async def _single_flight(self, key: str, fetch, *args):
+        """Run fetch(*args) once for all concurrent callers with the same key"""
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.create_task(fetch(*args))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # One caller being cancelled must not cancel the shared request
+        return await asyncio.shield(task)
+    
+    async def search(self, query: str):
+        search_query = SearchCache.identifier(query)
+        cached = self.search_cache.get(search_query)
+        if cached is not None:
+            return cached
+        return await self._single_flight(f"search:{SearchCache.key(search_query)}", self._search, search_query)
+    
+    async def _search(self, search_query: str):
+        # LavalinkBusy propagates to the caller
+        async with self.admission:
+            return await self._load(search_query)
+    
+    async def _load(self, search_query: str):
+        try:
+            result = await self._get_json("/v4/loadtracks", {"identifier": search_query}, LAVALINK_SEARCH_TIMEOUT)
+            # Only cache results that actually loaded something
+            if result and result.get("loadType") in ("track", "search", "playlist") and result.get("data"):
+                self.search_cache.set(search_query, result)
+            return result
+        except Exception as e:
+            logger.error(f"Search error: {e}")
+            return None
+    
+    def remember_track(self, track: dict):
+        """Record info of a loaded track so it never needs /v4/decodetrack"""
+        encoded = track.get("encoded")
+        info = track.get("info")
+        if not encoded or not info or DECODE_CACHE_SIZE <= 0:
+            return
+        self.decode_cache[encoded] = info
+        self.decode_cache.move_to_end(encoded)
+        while len(self.decode_cache) > DECODE_CACHE_SIZE:
+            self.decode_cache.popitem(last=False)
+    
+    async def decode_track(self, track_encoded: str):
+        info = self.decode_cache.get(track_encoded)
+        if info is not None:
+            self.decode_cache.move_to_end(track_encoded)
+            return info
+        return await self._single_flight(f"decode:{track_encoded}", self._decode_track, track_encoded)
+    
+    async def _decode_track(self, track_encoded: str):
+        try:
+            data = await self._get_json("/v4/decodetrack", {"encodedTrack": track_encoded}, LAVALINK_DECODE_TIMEOUT)
+            if not data:
+                return None
+            self.remember_track(data)
+            return data.get("info")
+        except Exception as e:
+            logger.error(f"Decode error: {e}")
+            return None
+    
+    async def get_stream_url(self, track_encoded: str):
+        info = await self.decode_track(track_encoded)
+        return info.get("uri") if info else None
+
+
+lavalink = LavaLinkClient(LAVALINK_NODES)
+editor = EditScheduler(EDIT_CHAT_INTERVAL, EDIT_GLOBAL_RATE)
+user_limiter = RateLimiter(PLAY_USER_RATE, PLAY_USER_BURST)
+chat_limiter = RateLimiter(PLAY_CHAT_RATE, PLAY_CHAT_BURST)
+
+
+class StreamPrefetcher:
+    """Resolves upcoming songs to playable URLs before they are needed"""
+    
+    def __init__(self, max_size: int = 256, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._pending: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _key(song: QueuedTrack) -> Optional[str]:
+        return song.uri or song.track
+    
+    def _lookup(self, key: str) -> Optional[str]:
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires, url = entry
+        if expires < time.monotonic():
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return url
+    
+    def _store(self, key: str, url: str):
+        self._cache[key] = (self._expiry(url), url)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+    
+    def _expiry(self, url: str) -> float:
+        """Monotonic deadline for a resolved URL, honouring its expire= parameter"""
+        ttl = self.ttl
+        expire = parse_qs(urlparse(url).query).get("expire")
+        if expire and expire[0].isdigit():
+            # Leave a margin so a song never starts on an about-to-expire URL
+            ttl = min(ttl, int(expire[0]) - time.time() - 60)
+        return time.monotonic() + ttl
+    
+    def _start(self, song: QueuedTrack, key: str) -> asyncio.Task:
+        task = asyncio.create_task(self._resolve(song, key))
+        self._pending[key] = task
+        task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return task
+    
+    def prefetch(self, songs: Iterable[QueuedTrack]):
+        """Start resolving songs in the background"""
+        for song in songs:
+            key = self._key(song)
+            if key and key not in self._pending and self._lookup(key) is None:
+                self._start(song, key)
+    
+    async def stream_url(self, song: QueuedTrack) -> Optional[str]:
+        key = self._key(song)
+        if not key:
+            return None
+        url = self._lookup(key)
+        if url is not None:
+            self.hits += 1
+            return url
+        self.misses += 1
+        task = self._pending.get(key) or self._start(song, key)
+        return await asyncio.shield(task)
+    
+    async def _resolve(self, song: QueuedTrack, key: str) -> Optional[str]:
+        uri = song.uri or await lavalink.get_stream_url(song.track)
+        if not uri:
+            return None
+        if not YT_DLP_AVAILABLE or not PREFETCH_EXTRACT:
+            self._store(key, uri)
+            return uri
+        try:
+            url = await asyncio.get_running_loop().run_in_executor(None, self._extract, uri)
+        except Exception as e:
+            # Let TgCalls resolve the page URL itself
+            logger.warning(f"Prefetch extract error for {song.title}: {e}")
+            return uri
+        self._store(key, url)
+        if PREFETCH_WARM and url != uri:
+            asyncio.create_task(self._warm(url))
+        return url
+    
+    @staticmethod
+    def _extract(uri: str) -> str:
+        import yt_dlp
+        with yt_dlp.YoutubeDL({"format": "bestaudio/best", "quiet": True, "no_warnings": True}) as ydl:
+            info = ydl.extract_info(uri, download=False)
+        return info.get("url") or uri
+    
+    async def _warm(self, url: str):
+        """Fetch the first bytes so the CDN connection and cache are hot"""
+        try:
+            async with lavalink.session.get(
+                url, headers={"Range": "bytes=0-65535"}, timeout=aiohttp.ClientTimeout(total=10)
+            ) as resp:
+                await resp.read()
+        except Exception as e:
+            logger.debug(f"Prefetch warm error: {e}")
+    
+    def stats(self) -> dict:
+        return {
+            "size": len(self._cache),
+            "pending": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+prefetcher = StreamPrefetcher(PREFETCH_CACHE_SIZE, PREFETCH_TTL)
+
+
+class AudioCache:
+    """On-disk LRU of downloaded audio for hot tracks, keyed by track identifier"""
+    
+    CHUNK = 10 * 2 ** 20
+    
+    def __init__(
+        self,
+        directory: Optional[str],
+        max_bytes: int,
+        max_duration: float = 900,
+        max_fills: int = 2,
+        pcm: bool = False
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_duration = max_duration
+        self.pcm = pcm
+        self._files: "OrderedDict[str, int]" = OrderedDict()  # name -> size, least recent first
+        self._size = 0
+        self._filling: Dict[str, asyncio.Task] = {}
+        self._slots = asyncio.Semaphore(max_fills)
+        self.hits = 0
+        self.misses = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+    
+    def load(self):
+        """Index files from earlier runs, using mtime as the recency order"""
+        if not self.enabled:
+            return
+        if self.pcm and shutil.which("ffmpeg") is None:
+            logger.warning("ffmpeg not found, the audio cache will keep tracks in their source format")
+            self.pcm = False
+        if self.pcm and TGCALLS_LIB == "ntgcalls":
+            # NTgCalls is handed the file path with no way to say it is headerless s16le
+            logger.warning("NTgCalls can't play raw PCM, the audio cache will keep tracks in their source format")
+            self.pcm = False
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".part"):
+                self._discard(entry.path)
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self._size += size
+        self._evict()
+        logger.info(f"✓ Audio cache: {len(self._files)} files, {self._size // 2 ** 20} MiB")
+    
+    def _name(self, song: QueuedTrack) -> Optional[str]:
+        if not song.identifier:
+            return None
+        name = hashlib.sha1(song.identifier.encode()).hexdigest()
+        return f"{name}.pcm" if self.pcm else name
+    
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+    
+    def __contains__(self, song: QueuedTrack) -> bool:
+        return self.enabled and self._name(song) in self._files
+    
+    def lookup(self, song: QueuedTrack) -> Optional[str]:
+        """Local file path for song, or None"""
+        if not self.enabled:
+            return None
+        name = self._name(song)
+        if name not in self._files:
+            self.misses += 1
+            return None
+        try:
+            os.utime(self._path(name))
+        except FileNotFoundError:
+            self._size -= self._files.pop(name)
+            self.misses += 1
+            return None
+        self._files.move_to_end(name)
+        self.hits += 1
+        return self._path(name)
+    
+    def fill(self, song: QueuedTrack, url: str):
+        """Download song from its resolved stream URL in the background"""
+        if not self.enabled:
+            return
+        name = self._name(song)
+        if (
+            name is None
+            or name in self._files
+            or name in self._filling
+            or not url.startswith(("http://", "https://"))
+            or song.duration > self.max_duration * 1000
+        ):
+            return
+        task = asyncio.create_task(self._fill(name, url, song.title))
+        self._filling[name] = task
+        task.add_done_callback(lambda _: self._filling.pop(name, None))
+    
+    async def _fill(self, name: str, url: str, title: str):
+        part = self._path(name) + ".part"
+        source = self._path(name) + ".src.part" if self.pcm else part
+        try:
+            async with self._slots:
+                size = await self._download(url, source)
+                if self.pcm:
+                    size = await self._transcode(source, part)
+        except Exception as e:
+            logger.warning(f"Audio cache fill error for {title}: {e}")
+            self._discard(part)
+            return
+        finally:
+            if source != part:
+                self._discard(source)
+        os.replace(part, self._path(name))
+        self._files[name] = size
+        self._size += size
+        self._evict()
+        logger.info(f"✓ Cached {title} ({size // 1024} KiB)")
+    
+    async def _download(self, url: str, path: str) -> int:
+        """Fetch url in ranged chunks, which media CDNs throttle less than one long read"""
+        size = 0
+        with open(path, "wb") as f:
+            while True:
+                async with lavalink.session.get(
+                    url,
+                    headers={"Range": f"bytes={size}-{size + self.CHUNK - 1}"},
+                    timeout=aiohttp.ClientTimeout(total=120)
+                ) as resp:
+                    resp.raise_for_status()
+                    if resp.content_type.startswith("text/"):
+                        raise ValueError(f"not audio ({resp.content_type})")
+                    async for block in resp.content.iter_chunked(2 ** 16):
+                        f.write(block)
+                        size += len(block)
+                    if size > self.max_bytes:
+                        raise ValueError("larger than the whole cache")
+                    total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+                    if resp.status != 206 or not total.isdigit() or size >= int(total):
+                        return size
+    
+    async def _transcode(self, source: str, target: str) -> int:
+        """Decode once to the raw PCM the call engine sends, so repeats skip decoding"""
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", source,
+            "-f", "s16le", "-ar", str(Assistant.PCM_RATE), "-ac", str(Assistant.PCM_CHANNELS), target,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        if process.returncode:
+            raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode().strip()[-200:]}")
+        size = os.path.getsize(target)
+        if size > self.max_bytes:
+            raise ValueError("larger than the whole cache")
+        return size
+    
+    @staticmethod
+    def _discard(path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    
+    def _evict(self):
+        while self._size > self.max_bytes and self._files:
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            self._discard(self._path(name))
+    
+    def stats(self) -> dict:
+        return {
+            "files": len(self._files),
+            "bytes": self._size,
+            "filling": len(self._filling),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+audio_cache = AudioCache(
+    AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES, AUDIO_CACHE_MAX_DURATION, AUDIO_CACHE_FILLS, AUDIO_CACHE_PCM
+)
+
+
+class PcmRing:
+    """Preallocated ring of fixed-size PCM frames with in-place gain"""
+    
+    def __init__(self, frame_size: int, frames: int):
+        self.frame_size = frame_size
+        self.frames = frames
+        self._buffer = bytearray(frame_size * frames)
+        view = memoryview(self._buffer)
+        # Slices and int16 views are made once; filling and sending reuse them
+        self._slots = [view[i * frame_size:(i + 1) * frame_size] for i in range(frames)]
+        self._samples = np.frombuffer(self._buffer, dtype=np.int16).reshape(frames, -1)
+        self._scratch = np.empty(self._samples.shape[1], dtype=np.float32)
+        self.tail = 0  # oldest frame still held
+        self.head = 0  # next frame to be written
+    
+    def __len__(self) -> int:
+        return self.head - self.tail
+    
+    def writable(self) -> Optional[memoryview]:
+        if len(self) == self.frames:
+            return None
+        return self._slots[self.head % self.frames]
+    
+    def commit(self):
+        self.head += 1
+    
+    def release(self):
+        self.tail += 1
+    
+    def frame_at(self, index: int) -> Optional[memoryview]:
+        """Frame number index, if it is held"""
+        if not self.tail <= index < self.head:
+            return None
+        return self._slots[index % self.frames]
+    
+    def samples_at(self, index: int) -> "np.ndarray":
+        """int16 view of frame number index"""
+        return self._samples[index % self.frames]
+    
+    def apply_gain(self, index: int, gain: float):
+        """Scale a frame in place, saturating at the int16 limits"""
+        frame = self.samples_at(index)
+        np.multiply(frame, gain, out=self._scratch)
+        np.clip(self._scratch, -32768, 32767, out=self._scratch)
+        np.copyto(frame, self._scratch, casting="unsafe")
+
+
+class PcmStream:
+    """One decode of a track into a PcmRing, read in step by one or more chats"""
+    
+    FRAME_SIZE = Assistant.PCM_RATE * Assistant.PCM_CHANNELS * 2 * FRAME_MS // 1000
+    
+    def __init__(self, stream_url: str, frames: int, start_frame: int = 0, key: Optional[str] = None):
+        self.stream_url = stream_url
+        self.start_frame = start_frame  # position in the track of ring frame 0
+        self.key = key  # set while other chats may join
+        self.ring = PcmRing(self.FRAME_SIZE, frames)
+        self.readers: Dict[int, int] = {}  # chat_id -> next ring frame
+        self.eof = False
+        self._space = asyncio.Event()
+        self._task = asyncio.create_task(self._produce())
+    
+    @property
+    def joinable(self) -> bool:
+        # A new reader starts at frame 0, which must still be in the ring
+        return (
+            self.key is not None
+            and self.ring.tail == 0
+            and max(self.readers.values(), default=0) < self.ring.frames // 2
+        )
+    
+    async def _writable(self) -> memoryview:
+        """A free slot, waiting while the slowest reader still needs the oldest frame"""
+        while True:
+            slowest = min(self.readers.values(), default=0)
+            # Decode at most half a ring ahead; the other half keeps frame 0 for late joiners
+            if self.ring.head < slowest + self.ring.frames // 2:
+                slot = self.ring.writable()
+                if slot is not None:
+                    return slot
+                # Frames are only dropped when space is needed
+                if self.ring.tail < slowest:
+                    self.ring.release()
+                    continue
+            self._space.clear()
+            await self._space.wait()
+    
+    async def _produce(self):
+        try:
+            if self.stream_url.endswith(".pcm"):
+                await self._read_file()
+            else:
+                await self._decode()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            ERRORS.inc(kind="decode")
+            logger.error(f"Decode error for {self.stream_url[:80]}: {e}")
+        finally:
+            self.eof = True
+    
+    async def _read_file(self):
+        with open(self.stream_url, "rb", buffering=0) as f:
+            f.seek(self.start_frame * self.FRAME_SIZE)
+            while True:
+                slot = await self._writable()
+                read = f.readinto(slot)
+                if not read:
+                    return
+                if read < len(slot):
+                    # Pad the last frame with silence
+                    slot[read:] = bytes(len(slot) - read)
+                self.ring.commit()
+    
+    async def _decode(self):
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-nostdin", "-loglevel", "error",
+            "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5",
+            "-ss", f"{self.start_frame * FRAME_MS / 1000:.2f}", "-i", self.stream_url,
+            "-f", "s16le", "-ar", str(Assistant.PCM_RATE), "-ac", str(Assistant.PCM_CHANNELS), "pipe:1",
+            stdout=asyncio.subprocess.PIPE
+        )
+        try:
+            while True:
+                slot = await self._writable()
+                try:
+                    slot[:] = await process.stdout.readexactly(len(slot))
+                except asyncio.IncompleteReadError as e:
+                    if e.partial:
+                        slot[:len(e.partial)] = e.partial
+                        slot[len(e.partial):] = bytes(len(slot) - len(e.partial))
+                        self.ring.commit()
+                    return
+                self.ring.commit()
+        finally:
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+    
+    def subscribe(self, chat_id: int):
+        self.readers[chat_id] = 0
+    
+    def unsubscribe(self, chat_id: int) -> int:
+        """Drop a reader; returns its position in the track, in frames"""
+        position = self.start_frame + self.readers.pop(chat_id)
+        self._space.set()
+        if not self.readers:
+            self._task.cancel()
+        return position
+    
+    def frame(self, chat_id: int) -> Optional[memoryview]:
+        """chat_id's next frame, or None while decoding lags behind"""
+        return self.ring.frame_at(self.readers[chat_id])
+    
+    def advance(self, chat_id: int):
+        self.readers[chat_id] += 1
+        self._space.set()
+    
+    def finished(self, chat_id: int) -> bool:
+        return self.eof and self.readers[chat_id] >= self.ring.head
+
+
+class FrameCall:
+    """A call fed by the frame pump"""
+    
+    __slots__ = ("assistant", "stream", "gain", "paused")
+    
+    def __init__(self, assistant: "Assistant", stream: PcmStream, gain: float):
+        self.assistant = assistant
+        self.stream = stream
+        self.gain = gain
+        self.paused = False
+
+
+class FramePump:
+    """Pushes one frame per frame-mode call every FRAME_MS, from a single task"""
+    
+    def __init__(self):
+        self.calls: Dict[int, FrameCall] = {}
+        # Track key -> the stream new chats playing that track may join
+        self.shared: Dict[str, PcmStream] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.late_ticks = 0
+        self.decodes = 0
+        self.joins = 0
+    
+    def play(self, chat_id: int, assistant: "Assistant", stream_url: str, key: Optional[str], gain: float):
+        """Start chat_id on stream_url, sharing the decode with chats that just started the same track"""
+        self.remove(chat_id)
+        stream = self.shared.get(key) if key and gain == 1.0 else None
+        if stream is not None and stream.joinable:
+            self.joins += 1
+        else:
+            stream = self._open(stream_url, key=key if gain == 1.0 else None)
+        stream.subscribe(chat_id)
+        self.calls[chat_id] = FrameCall(assistant, stream, gain)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    def _open(self, stream_url: str, start_frame: int = 0, key: Optional[str] = None) -> PcmStream:
+        self.decodes += 1
+        if key is None:
+            return PcmStream(stream_url, FRAME_RING_FRAMES, start_frame)
+        stream = self.shared[key] = PcmStream(stream_url, FRAME_SHARE_FRAMES, start_frame, key)
+        return stream
+    
+    def _detach(self, chat_id: int) -> int:
+        stream = self.calls[chat_id].stream
+        position = stream.unsubscribe(chat_id)
+        if not stream.readers and stream.key is not None and self.shared.get(stream.key) is stream:
+            del self.shared[stream.key]
+        return position
+    
+    def _go_private(self, chat_id: int):
+        """Give chat_id its own stream from where it is, so it can pause or change gain alone"""
+        call = self.calls[chat_id]
+        if len(call.stream.readers) == 1:
+            # Already alone; just stop others from joining
+            if call.stream.key is not None and self.shared.get(call.stream.key) is call.stream:
+                del self.shared[call.stream.key]
+            call.stream.key = None
+            return
+        position = self._detach(chat_id)
+        call.stream = self._open(call.stream.stream_url, position)
+        call.stream.subscribe(chat_id)
+    
+    def remove(self, chat_id: int):
+        if chat_id in self.calls:
+            self._detach(chat_id)
+            del self.calls[chat_id]
+    
+    def get(self, chat_id: int) -> Optional[FrameCall]:
+        return self.calls.get(chat_id)
+    
+    def pause(self, chat_id: int):
+        self._go_private(chat_id)
+        self.calls[chat_id].paused = True
+    
+    def resume(self, chat_id: int):
+        self.calls[chat_id].paused = False
+    
+    def set_gain(self, chat_id: int, gain: float):
+        if gain != 1.0:
+            self._go_private(chat_id)
+        self.calls[chat_id].gain = gain
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        interval = FRAME_MS / 1000
+        next_tick = loop.time()
+        while self.calls:
+            sends, sent, ended = [], [], []
+            for chat_id, call in list(self.calls.items()):
+                if call.paused:
+                    continue
+                if call.stream.finished(chat_id):
+                    ended.append(chat_id)
+                    continue
+                frame = call.stream.frame(chat_id)
+                if frame is None:
+                    continue
+                if call.gain != 1.0:
+                    # Only private streams carry a gain, so this frame is ours to change
+                    call.stream.ring.apply_gain(call.stream.readers[chat_id], call.gain)
+                sends.append(call.assistant.send_frame(chat_id, frame))
+                sent.append(chat_id)
+            results = await asyncio.gather(*sends, return_exceptions=True)
+            for chat_id, result in zip(sent, results):
+                call = self.calls.get(chat_id)
+                if call is not None and chat_id in call.stream.readers:
+                    call.stream.advance(chat_id)
+                if isinstance(result, Exception):
+                    logger.debug(f"Frame send error: {result!r}")
+            for chat_id in ended:
+                self.remove(chat_id)
+                on_stream_end(chat_id)
+            
+            next_tick += interval
+            delay = next_tick - loop.time()
+            if delay < -5 * interval:
+                # Too far behind to catch up without a burst; drop the backlog
+                self.late_ticks += 1
+                next_tick = loop.time()
+                delay = 0
+            await asyncio.sleep(max(delay, 0))
+    
+    def stats(self) -> dict:
+        return {
+            "calls": len(self.calls),
+            "shared": len(self.shared),
+            "decodes": self.decodes,
+            "joins": self.joins,
+            "late_ticks": self.late_ticks,
+        }
+
+
+frame_pump = FramePump()
+
+
+class QueueJournal:
+    """Append-only log of queue changes, replayed on startup"""
+    
+    def __init__(self, path: Optional[str], compact_every: int = 10000):
+        self.path = path
+        self.compact_every = compact_every
+        self._file = None
+        self._lines = 0
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+    
+    def load(self) -> Dict[int, tuple]:
+        """Replay the journal into {chat_id: (current, ChatQueue)}"""
+        state: Dict[int, tuple] = {}
+        if not self.enabled or not os.path.exists(self.path):
+            return state
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line from a crash
+                    continue
+                self._lines += 1
+                chat_id = entry["chat"]
+                current, queue = state.get(chat_id, (None, ChatQueue()))
+                op = entry["op"]
+                if op == "add":
+                    queue.extend(QueuedTrack.from_dict(t) for t in entry["tracks"])
+                elif op == "next":
+                    current = queue.pop()
+                elif op == "idle":
+                    current = None
+                elif op == "clear":
+                    current = None
+                    queue.clear()
+                elif op == "set":
+                    queue = ChatQueue(QueuedTrack.from_dict(t) for t in entry["tracks"])
+                elif op == "snapshot":
+                    current = QueuedTrack.from_dict(entry["current"]) if entry["current"] else None
+                    queue = ChatQueue(QueuedTrack.from_dict(t) for t in entry["tracks"])
+                elif op == "remove":
+                    queue.remove(entry["index"])
+                elif op == "move":
+                    queue.move(entry["src"], entry["dst"])
+                state[chat_id] = (current, queue)
+        return {chat_id: s for chat_id, s in state.items() if s[0] or s[1]}
+    
+    def record(self, chat_id: int, op: str, **data):
+        if not self.enabled:
+            return
+        if self._file is None:
+            self._file = open(self.path, "a")
+        data["chat"] = chat_id
+        data["op"] = op
+        self._file.write(json.dumps(data, separators=(",", ":")) + "\n")
+        self._file.flush()
+        self._lines += 1
+        if self._lines >= self.compact_every:
+            self.compact()
+    
+    def compact(self):
+        """Rewrite the journal as one snapshot per active chat"""
+        if not self.enabled:
+            return
+        lines = self.write_snapshot(
+            (chat_id, player.current, player.queue) for chat_id, player in players.items()
+        )
+        logger.info(f"✓ Queue journal compacted ({lines} chats)")
+    
+    def write_snapshot(self, chats: Iterable[tuple]) -> int:
+        """Replace the journal with (chat_id, current, queue) snapshots; returns chats written"""
+        tmp_path = f"{self.path}.tmp"
+        lines = 0
+        with open(tmp_path, "w") as f:
+            for chat_id, current, queue in chats:
+                if current is None and not queue:
+                    continue
+                f.write(json.dumps({
+                    "chat": chat_id,
+                    "op": "snapshot",
+                    "current": current.to_dict() if current else None,
+                    "tracks": [t.to_dict() for t in queue],
+                }, separators=(",", ":")) + "\n")
+                lines += 1
+            f.flush()
+            os.fsync(f.fileno())
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        os.replace(tmp_path, self.path)
+        self._lines = lines
+        return lines
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+journal = QueueJournal(STATE_JOURNAL, STATE_COMPACT_EVERY)
+
+
+def journal_path(chat_id: int) -> str:
+    """Journal that chat_id's owner reads under the current WORKERS setting"""
+    return f"{STATE_JOURNAL}.worker{chat_id % WORKERS}" if WORKERS else STATE_JOURNAL
+
+
+def partition_journals():
+    """Move each chat into the journal of the process that owns it, before any worker starts"""
+    # Changing WORKERS between runs (or turning workers on or off) changes which process owns a chat
+    if not STATE_JOURNAL:
+        return
+    directory = os.path.dirname(STATE_JOURNAL)
+    prefix = os.path.basename(STATE_JOURNAL)
+    paths = [
+        os.path.join(directory, name) for name in sorted(os.listdir(directory or "."))
+        if name == prefix or (name.startswith(f"{prefix}.worker") and not name.endswith(".tmp"))
+    ]
+    chats: Dict[str, list] = {}
+    misplaced = 0
+    for path in paths:
+        for chat_id, (current, queue) in QueueJournal(path).load().items():
+            owner = journal_path(chat_id)
+            misplaced += owner != path
+            chats.setdefault(owner, []).append((chat_id, current, queue))
+    if not misplaced:
+        return
+    for path, entries in chats.items():
+        QueueJournal(path).write_snapshot(entries)
+    for path in paths:
+        if path not in chats:
+            os.remove(path)
+    logger.info(f"✓ Moved {misplaced} chats to the journal of their owning process")
+
+
+class HotTracks:
+    """Play counts of the most played tracks, saved across restarts to warm caches"""
+    
+    def __init__(self, path: Optional[str], size: int = 200):
+        self.path = path
+        self.size = size
+        self._tracks: Dict[str, list] = {}  # identifier -> [plays, QueuedTrack]
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+    
+    def record(self, song: QueuedTrack):
+        if not self.enabled or not song.identifier:
+            return
+        entry = self._tracks.get(song.identifier)
+        if entry is None:
+            entry = self._tracks[song.identifier] = [0, song]
+        entry[0] += 1
+        if len(self._tracks) > 2 * self.size:
+            self._trim()
+    
+    def _trim(self):
+        hottest = sorted(self._tracks.items(), key=lambda item: item[1][0], reverse=True)[:self.size]
+        self._tracks = dict(hottest)
+    
+    def hottest(self, count: Optional[int] = None) -> List[QueuedTrack]:
+        entries = sorted(self._tracks.values(), key=lambda entry: entry[0], reverse=True)
+        return [song for _, song in entries[:count]]
+    
+    def load(self) -> int:
+        if not self.enabled or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, "r") as f:
+                for entry in json.load(f):
+                    song = QueuedTrack.from_dict(entry["track"])
+                    self._tracks[song.identifier] = [entry["plays"], song]
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable {self.path}: {e}")
+        return len(self._tracks)
+    
+    def save(self):
+        if not self.enabled or not self._tracks:
+            return
+        self._trim()
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump([
+                {"plays": plays, "track": {**song.to_dict(), "requester": None}}
+                for plays, song in sorted(self._tracks.values(), key=lambda entry: entry[0], reverse=True)
+            ], f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+
+hot_tracks = HotTracks(HOT_TRACKS_FILE, HOT_TRACKS_SIZE)
+
+
+# Global variables
+players: Dict[int, "ChatPlayer"] = {}
+
+
+class ChatPlayer:
+    """Owns one chat's queue and call state, running its commands one at a time"""
+    
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.queue = ChatQueue()
+        self.current: Optional[QueuedTrack] = None
+        self.in_call = False
+        self.assistant: Optional[Assistant] = None
+        self.failures = 0
+        self.generation = 0  # bumped by stop
+        self.ended_at: Optional[float] = None
+        self.last_gap: Optional[float] = None
+        self.volume = 1.0
+        self._retry: Optional[asyncio.TimerHandle] = None
+        self._inbox: asyncio.Queue = asyncio.Queue()
+        self._task: Optional[asyncio.Task] = None
+    
+    @property
+    def idle(self) -> bool:
+        return self.current is None and not self.queue and self._retry is None
+    
+    def submit(self, command, *args) -> asyncio.Future:
+        """Queue a command coroutine function; returns a future for its result"""
+        future = asyncio.get_running_loop().create_future()
+        self._inbox.put_nowait((command, args, future))
+        if self._task is None or self._task.done():
+            players.setdefault(self.chat_id, self)
+            self._task = asyncio.create_task(self._run())
+        return future
+    
+    async def execute(self, command, *args):
+        return await self.submit(command, *args)
+    
+    async def _run(self):
+        while True:
+            try:
+                command, args, future = await asyncio.wait_for(self._inbox.get(), PLAYER_IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                if self.idle and self._inbox.empty():
+                    if players.get(self.chat_id) is self:
+                        del players[self.chat_id]
+                    return
+                continue
+            if future.cancelled():
+                continue
+            try:
+                result = await command(*args)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            else:
+                if not future.cancelled():
+                    future.set_result(result)
+    
+    # Commands below only run inside the actor task
+    
+    def _cancel_retry(self):
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+    
+    def _schedule_retry(self, delay: float):
+        def retry():
+            self._retry = None
+            self.submit(self.advance)
+        self._retry = asyncio.get_running_loop().call_later(delay, retry)
+    
+    async def _leave(self):
+        self.in_call = False
+        frame_pump.remove(self.chat_id)
+        if self.assistant is None:
+            return
+        try:
+            await self.assistant.leave(self.chat_id)
+        except Exception as e:
+            logger.warning(f"⚠ Leaving call in {self.chat_id} failed: {e!r}")
+        assistants.release(self.chat_id)
+        self.assistant = None
+    
+    def _prefetch_upcoming(self):
+        prefetcher.prefetch(song for song in self.queue.peek(PREFETCH_COUNT) if song not in audio_cache)
+    
+    async def _start_stream(self, stream_url: str, key: Optional[str] = None):
+        if self.assistant is None:
+            self.assistant = assistants.assign(self.chat_id)
+        framed = frame_pump.get(self.chat_id) is not None
+        if (
+            FRAME_PIPELINE
+            and self.assistant.supports_frames
+            and (stream_url.endswith(".pcm") or FRAME_BROADCAST)
+        ):
+            # Cached PCM is already in the call's format and is pushed without ffmpeg;
+            # in broadcast mode chats starting the same track share one decode
+            if not framed:
+                await self.assistant.start_frames(self.chat_id)
+            frame_pump.play(
+                self.chat_id, self.assistant, stream_url,
+                key if FRAME_BROADCAST else None, self.volume
+            )
+            self.in_call = True
+            return
+        frame_pump.remove(self.chat_id)
+        if self.in_call:
+            await self.assistant.change_stream(self.chat_id, stream_url)
+        else:
+            await self.assistant.join(self.chat_id, stream_url)
+        self.in_call = True
+    
+    async def advance(self):
+        """Play the next song; a failing song is skipped after a backoff"""
+        self._cancel_retry()
+        song = self.queue.pop()
+        self.current = song
+        journal.record(self.chat_id, "next")
+        if song is None:
+            await self._leave()
+            return
+        
+        try:
+            stream_url = audio_cache.lookup(song) or await prefetcher.stream_url(song)
+            if not stream_url:
+                raise ValueError(f"no stream URL for {song.title}")
+            await self._start_stream(stream_url, song.identifier or song.uri)
+            self.failures = 0
+            hot_tracks.record(song)
+            audio_cache.fill(song, stream_url)
+            self._prefetch_upcoming()
+            if self.ended_at is not None:
+                self.last_gap = time.monotonic() - self.ended_at
+                self.ended_at = None
+                TRANSITION_SECONDS.observe(self.last_gap)
+                logger.info(f"✓ Playing in {self.chat_id}: {song.title} (gap {self.last_gap * 1000:.0f} ms)")
+            else:
+                logger.info(f"✓ Playing in {self.chat_id}: {song.title}")
+            return
+        except Exception as e:
+            self.failures += 1
+            ERRORS.inc(kind="play")
+            logger.error(f"Play error ({self.failures}/{PLAY_MAX_FAILURES}): {e}")
+        
+        if self.failures >= PLAY_MAX_FAILURES:
+            # Keep the rest of the queue; the next /play picks it up again
+            failures, self.failures = self.failures, 0
+            self.current = None
+            journal.record(self.chat_id, "idle")
+            await self._leave()
+            logger.warning(f"⚠ {failures} songs failed in a row in {self.chat_id}, playback paused")
+            await notify(
+                self.chat_id,
+                f"⚠️ {failures} songs failed to play in a row, playback paused.\n"
+                "Use /play to try again."
+            )
+            return
+        
+        self.current = None
+        journal.record(self.chat_id, "idle")
+        self._schedule_retry(min(PLAY_RETRY_BASE_DELAY * 2 ** (self.failures - 1), PLAY_RETRY_MAX_DELAY))
+    
+    async def enqueue(self, tracks: List[QueuedTrack]) -> str:
+        """Add songs, starting playback if idle; returns "playing", "retrying" or "queued"."""
+        self.queue.extend(tracks)
+        journal.record(self.chat_id, "add", tracks=[t.to_dict() for t in tracks])
+        if self.current is None and self._retry is None:
+            await self.advance()
+            return "playing" if self.in_call and self.current is not None else "retrying"
+        self._prefetch_upcoming()
+        return "queued"
+    
+    async def skip(self) -> bool:
+        if self.current is None:
+            return False
+        self.ended_at = None
+        await self.advance()
+        return True
+    
+    async def stream_ended(self, song: QueuedTrack, ended_at: float):
+        # Ignore end events for a song that was already skipped or stopped
+        if self.current is not song:
+            return
+        self.ended_at = ended_at
+        await self.advance()
+    
+    async def stop(self) -> bool:
+        if self.idle:
+            return False
+        self._cancel_retry()
+        self.generation += 1
+        self.ended_at = None
+        self.queue.clear()
+        self.current = None
+        self.failures = 0
+        journal.record(self.chat_id, "clear")
+        await self._leave()
+        return True
+    
+    async def pause(self) -> bool:
+        if not self.in_call:
+            return False
+        if frame_pump.get(self.chat_id) is not None:
+            frame_pump.pause(self.chat_id)
+        else:
+            await self.assistant.pause(self.chat_id)
+        return True
+    
+    async def resume(self) -> bool:
+        if not self.in_call:
+            return False
+        if frame_pump.get(self.chat_id) is not None:
+            frame_pump.resume(self.chat_id)
+        else:
+            await self.assistant.resume(self.chat_id)
+        return True
+    
+    async def set_volume(self, volume: float) -> bool:
+        """Set the gain for songs pushed as frames; returns whether it applies right now"""
+        self.volume = volume
+        if frame_pump.get(self.chat_id) is None:
+            return False
+        frame_pump.set_gain(self.chat_id, volume)
+        return True
+    
+    async def shuffle(self) -> bool:
+        if len(self.queue) < 2:
+            return False
+        self.queue.shuffle()
+        journal.record(self.chat_id, "set", tracks=[t.to_dict() for t in self.queue])
+        return True
+    
+    async def remove(self, index: int) -> Optional[QueuedTrack]:
+        if not 0 <= index < len(self.queue):
+            return None
+        song = self.queue.remove(index)
+        journal.record(self.chat_id, "remove", index=index)
+        return song
+    
+    async def move(self, src: int, dst: int) -> Optional[QueuedTrack]:
+        if not (0 <= src < len(self.queue) and 0 <= dst < len(self.queue)):
+            return None
+        self.queue.move(src, dst)
+        journal.record(self.chat_id, "move", src=src, dst=dst)
+        return self.queue[dst]
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
-logging.getLogger("pyrogram.session").setLevel(logging.WARNING)
-logging.getLogger("pyrogram.connection").setLevel(logging.WARNING)
 
-logger.info("="*60)
-logger.info("MUSIC BOT STARTING")
-logger.info("="*60)
+def get_player(chat_id: int) -> ChatPlayer:
+    player = players.get(chat_id)
+    if player is None:
+        player = players[chat_id] = ChatPlayer(chat_id)
+    return player
 
-# Import config
-try:
-    from config import API_ID, API_HASH, LAVALINK_HOST, LAVALINK_PORT, LAVALINK_PASSWORD
-    logger.info(f"✓ Config loaded - API_ID: {API_ID}")
+
+def queue_page(queue: ChatQueue, page: int) -> tuple:
+    """Text and (label, callback data) buttons for one /queue page, cached until the queue changes"""
+    pages = max(1, -(-len(queue) // QUEUE_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    cached = queue.pages.get(page)
+    if cached is not None:
+        return cached
     
-    try:
-        from config import BOT_TOKEN
-        USE_USERBOT = False
-        logger.info(f"✓ Using BOT mode")
-    except ImportError:
-        BOT_TOKEN = None
-        USE_USERBOT = True
-        logger.info("✓ Using USERBOT mode")
-except ImportError as e:
-    logger.error(f"❌ Config error: {e}")
-    sys.exit(1)
+    start = page * QUEUE_PAGE_SIZE
+    lines = ["📜 **Queue:**\n"]
+    for i, song in enumerate(queue.peek(QUEUE_PAGE_SIZE, start), start + 1):
+        lines.append(f"{i}. **{song.title}**\n   {song.author} | {format_duration(song.duration)}\n")
+    lines.append(f"⏱ Total: {format_duration(queue.total_duration)} ({len(queue)} songs)")
+    if pages > 1:
+        lines.append(f"📄 Page {page + 1}/{pages}")
+    
+    buttons = []
+    if page > 0:
+        buttons.append(("◀️ Prev", f"queue:{page - 1}"))
+    if page < pages - 1:
+        buttons.append(("Next ▶️", f"queue:{page + 1}"))
+    
+    queue.pages[page] = ("\n".join(lines), buttons)
+    return queue.pages[page]
 
-# Detect TgCalls library
-TGCALLS_LIB = None
-try:
-    with open(".tgcalls_lib", "r") as f:
-        TGCALLS_LIB = f.read().strip()
-except:
-    pass
 
-if TGCALLS_LIB == "ntgcalls":
-    try:
-        from ntgcalls import NTgCalls
-        logger.info("✓ Using NTgCalls")
-    except ImportError:
-        logger.error("❌ NTgCalls not found!")
-        sys.exit(1)
-else:
+async def player_command(chat_id: int, op: str, *args):
+    """Run a player operation in this process; arguments and results are JSON-safe"""
+    if op == "enqueue":
+        # Returns the player's generation with the state, read inside the same command,
+        # and skips the songs if an expected generation is given and a /stop has bumped it
+        player = get_player(chat_id)
+        tracks = [QueuedTrack.from_dict(t) for t in args[0]]
+        expected = args[1] if len(args) > 1 else None
+        
+        async def enqueue():
+            if expected is not None and player.generation != expected:
+                return {"state": "stopped", "generation": player.generation}
+            return {"state": await player.enqueue(tracks), "generation": player.generation}
+        return await player.execute(enqueue)
+    if op == "volume":
+        player = get_player(chat_id)
+        return await player.execute(player.set_volume, args[0])
+    
+    player = players.get(chat_id)
+    if op == "queue_page":
+        return queue_page(player.queue, args[0]) if player and player.queue else None
+    if op == "now_playing":
+        if not player or not player.current:
+            return None
+        return {
+            "song": player.current.to_dict(),
+            "upcoming": len(player.queue),
+            "upcoming_duration": player.queue.total_duration,
+        }
+    if op in ("skip", "stop", "pause", "resume", "shuffle"):
+        return await player.execute(getattr(player, op)) if player else False
+    if op in ("remove", "move"):
+        song = await player.execute(getattr(player, op), *args) if player else None
+        return song.to_dict() if song else None
+    raise ValueError(f"unknown player command: {op}")
+
+
+async def dispatch(chat_id: int, op: str, *args):
+    """Run a player operation wherever chat_id's player lives"""
+    if supervisor is not None:
+        return await supervisor.call(chat_id, op, list(args))
+    return await player_command(chat_id, op, *args)
+
+
+async def notify(chat_id: int, text: str):
+    """Send a message to a chat from outside a command handler"""
+    if worker_server is not None:
+        # Workers have no bot session; the front process sends it
+        worker_server.notify(chat_id, text)
+        return
     try:
-        from pytgcalls import PyTgCalls
-        from pytgcalls.types import MediaStream
-        logger.info("✓ Using PyTgCalls")
-        TGCALLS_LIB = "pytgcalls"
-    except ImportError:
-        logger.error("❌ No TgCalls library found!")
-        sys.exit(1)
+        await app.send_message(chat_id, text)
+    except Exception as e:
+        logger.error(f"Notify error: {e}")
 
-try:
-    import aiohttp
-except ImportError:
-    logger.error("❌ aiohttp not found!")
-    sys.exit(1)
 
-# Initialize client WITHOUT plugins parameter
-if USE_USERBOT:
-    app = Client("music_userbot", api_id=API_ID, api_hash=API_HASH)
-else:
-    app = Client("music_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
+WORKER_LINE_LIMIT = 2 ** 20
 
-# Initialize TgCalls
-if TGCALLS_LIB == "ntgcalls":
-    tgcalls = NTgCalls()
-else:
-    tgcalls = PyTgCalls(app)
 
-# Global variables
-queues: Dict[int, list] = {}
-current_playing: Dict[int, dict] = {}
+class WorkerError(Exception):
+    """A player command failed in, or never reached, its worker process"""
 
 
-class LavaLinkClient:
-    """Lavalink client"""
+def worker_socket(index: int) -> str:
+    return os.path.join(WORKER_SOCKET_DIR, f"music_bot.worker{index}.sock")
+
+
+def send_line(writer, message: dict):
+    writer.write(json.dumps(message).encode() + b"\n")
+
+
+class WorkerServer:
+    """Serves player commands from the front process over a unix socket"""
     
-    def __init__(self, host, port, password):
-        self.host = host
-        self.port = port
-        self.password = password
-        self.base_url = f"http://{host}:{port}"
-        self.session = None
-        self.headers = {"Authorization": password, "Content-Type": "application/json"}
+    def __init__(self, path: str):
+        self.path = path
+        self._server = None
+        self._writer = None
+        self._tasks = set()
+        # Notifications raised while the front is disconnected
+        self._outbox = deque(maxlen=1000)
     
-    async def initialize(self):
-        self.session = aiohttp.ClientSession()
-        logger.info("✓ Lavalink session initialized")
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, self.path, limit=WORKER_LINE_LIMIT)
     
-    async def close(self):
-        if self.session:
-            await self.session.close()
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._writer is not None:
+            self._writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
     
-    async def search(self, query: str):
+    async def _serve(self, reader, writer):
+        self._writer = writer
+        while self._outbox:
+            send_line(writer, self._outbox.popleft())
         try:
-            search_query = f"ytsearch:{query}" if not query.startswith("http") else query
-            async with self.session.get(
-                f"{self.base_url}/v4/loadtracks",
-                params={"identifier": search_query},
-                headers=self.headers
-            ) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                return None
-        except Exception as e:
-            logger.error(f"Search error: {e}")
-            return None
+            while line := await reader.readline():
+                # Each chat's actor keeps its own commands in order
+                task = asyncio.create_task(self._handle(writer, json.loads(line)))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        finally:
+            if self._writer is writer:
+                self._writer = None
+            writer.close()
     
-    async def get_stream_url(self, track_encoded: str):
+    async def _handle(self, writer, request: dict):
         try:
-            async with self.session.get(
-                f"{self.base_url}/v4/decodetrack",
-                params={"encodedTrack": track_encoded},
-                headers=self.headers
-            ) as resp:
-                if resp.status == 200:
-                    data = await resp.json()
-                    return data.get("uri")
-                return None
+            reply = {"id": request["id"], "result": await player_command(request["chat"], request["op"], *request["args"])}
         except Exception as e:
-            logger.error(f"Stream URL error: {e}")
-            return None
+            logger.error(f"Worker command {request['op']} failed: {e}", exc_info=True)
+            reply = {"id": request["id"], "error": str(e)}
+        if not writer.is_closing():
+            send_line(writer, reply)
+    
+    def notify(self, chat_id: int, text: str):
+        message = {"event": "notify", "chat": chat_id, "text": text}
+        if self._writer is None or self._writer.is_closing():
+            self._outbox.append(message)
+        else:
+            send_line(self._writer, message)
+
+
+class WorkerLink:
+    """The front process's connection to one worker"""
+    
+    def __init__(self, index: int):
+        self.index = index
+        self.path = worker_socket(index)
+        self._writer = None
+        self._reader_task = None
+        self._connected = asyncio.Event()
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._next_id = 0
+    
+    async def connect(self):
+        """Keep trying until the worker is listening"""
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(self.path, limit=WORKER_LINE_LIMIT)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.2)
+        self._reader_task = asyncio.create_task(self._read(reader))
+        self._connected.set()
+        logger.info(f"✓ Connected to worker {self.index}")
+    
+    async def close(self):
+        self._connected.clear()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        self._fail_pending()
+    
+    def _fail_pending(self):
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(WorkerError(f"worker {self.index} disconnected"))
+        self._pending.clear()
+    
+    async def _read(self, reader):
+        try:
+            while line := await reader.readline():
+                message = json.loads(line)
+                if message.get("event") == "notify":
+                    asyncio.create_task(notify(message["chat"], message["text"]))
+                    continue
+                future = self._pending.pop(message["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in message:
+                    future.set_exception(WorkerError(message["error"]))
+                else:
+                    future.set_result(message["result"])
+        finally:
+            self._connected.clear()
+            self._fail_pending()
+    
+    async def call(self, chat_id: int, op: str, args: list):
+        try:
+            await asyncio.wait_for(self._connected.wait(), WORKER_CALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise WorkerError(f"worker {self.index} is not running")
+        
+        self._next_id += 1
+        request_id = self._next_id
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        send_line(self._writer, {"id": request_id, "chat": chat_id, "op": op, "args": args})
+        try:
+            return await asyncio.wait_for(future, WORKER_CALL_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise WorkerError(f"worker {self.index} did not answer {op}")
+        finally:
+            self._pending.pop(request_id, None)
+
+
+class WorkerSupervisor:
+    """Runs the worker processes, restarting any that exit, and routes chats to them"""
+    
+    def __init__(self, count: int):
+        self.links = [WorkerLink(i) for i in range(count)]
+        self._processes = {}
+        self._tasks = []
+        self._stopping = False
+    
+    def start(self):
+        self._tasks = [asyncio.create_task(self._run(link)) for link in self.links]
+    
+    async def _run(self, link: WorkerLink):
+        delay = 1
+        while not self._stopping:
+            started = time.monotonic()
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__),
+                "--worker", str(link.index), "--workers", str(len(self.links))
+            )
+            self._processes[link.index] = process
+            connecting = asyncio.create_task(link.connect())
+            code = await process.wait()
+            connecting.cancel()
+            await link.close()
+            if self._stopping:
+                return
+            # Back off if the worker keeps dying right after starting
+            delay = 1 if time.monotonic() - started > 60 else min(delay * 2, 30)
+            logger.error(f"❌ Worker {link.index} exited with code {code}, restarting in {delay}s")
+            await asyncio.sleep(delay)
+    
+    async def stop(self):
+        self._stopping = True
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.terminate()
+        for process in self._processes.values():
+            try:
+                await asyncio.wait_for(process.wait(), 10)
+            except asyncio.TimeoutError:
+                process.kill()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+    
+    async def call(self, chat_id: int, op: str, args: list):
+        # A chat always lands on the same worker, which owns its player and call
+        return await self.links[chat_id % len(self.links)].call(chat_id, op, args)
+
+
+# Set in the front process when WORKERS > 0, and in each worker respectively
+supervisor: Optional[WorkerSupervisor] = None
+worker_server: Optional[WorkerServer] = None
 
 
-lavalink = LavaLinkClient(LAVALINK_HOST, LAVALINK_PORT, LAVALINK_PASSWORD)
+def restore_players() -> List[ChatPlayer]:
+    """Rehydrate every chat's queue from the journal; returns the players to rejoin"""
+    if not journal.enabled:
+        return []
+    restored = []
+    for chat_id, (current, queue) in journal.load().items():
+        if WORKER_INDEX is not None and chat_id % WORKERS != WORKER_INDEX:
+            # partition_journals() moves these; the front would never route commands here
+            logger.warning(f"⚠ Chat {chat_id} belongs to worker {chat_id % WORKERS}, not restored here")
+            continue
+        # The interrupted song restarts from the beginning
+        player = get_player(chat_id)
+        player.queue = ChatQueue([current] if current else [])
+        player.queue.extend(queue)
+        restored.append(player)
+    # Replace the replayed history with one snapshot per chat
+    journal.compact()
+    return restored
+
+
+async def rejoin_players(restored: List[ChatPlayer]):
+    """Start playback again in every restored chat, in parallel"""
+    if not restored:
+        return
+    started = time.monotonic()
+    results = await asyncio.gather(
+        *(player.execute(player.advance) for player in restored),
+        return_exceptions=True
+    )
+    failed = sum(isinstance(r, Exception) for r in results)
+    logger.info(
+        f"✓ Restored {len(restored) - failed}/{len(restored)} chats "
+        f"in {(time.monotonic() - started) * 1000:.0f} ms"
+    )
+
+
+metrics.gauge(
+    "musicbot_queue_depth", "Songs waiting per chat",
+    lambda: [({"chat": chat_id}, len(player.queue)) for chat_id, player in list(players.items())]
+)
+metrics.gauge(
+    "musicbot_active_calls", "Voice chats currently joined",
+    lambda: [({}, sum(player.in_call for player in list(players.values())))]
+)
+metrics.gauge(
+    "musicbot_assistant_calls", "Voice chats assigned per assistant",
+    lambda: [({"assistant": name}, load) for name, load in assistants.stats().items()]
+)
+metrics.gauge(
+    "musicbot_lavalink_node_load", "Lavalink CPU load reported over the WebSocket session",
+    lambda: [({"node": node.name}, node.load) for node in lavalink.nodes if node.stats_at]
+)
+metrics.gauge(
+    "musicbot_lavalink_node_in_flight", "Requests in flight per Lavalink node",
+    lambda: [({"node": node.name}, node.in_flight) for node in lavalink.nodes]
+)
+metrics.gauge(
+    "musicbot_lavalink_node_error_rate", "Recent failed request ratio per Lavalink node",
+    lambda: [({"node": node.name}, node.error_rate) for node in lavalink.nodes]
+)
+metrics.gauge(
+    "musicbot_lavalink_pool_waiting", "Lavalink requests waiting for a pooled connection now",
+    lambda: [({}, lavalink.pool_stats.waiting)]
+)
+metrics.counter_reader(
+    "musicbot_lavalink_pool_queued_total", "Lavalink requests that had to wait for a pooled connection",
+    lambda: [({}, lavalink.pool_stats.queued)]
+)
+metrics.gauge(
+    "musicbot_lavalink_pool_wait_seconds", "Wait for a pooled Lavalink connection",
+    lambda: [
+        ({"stat": "avg"}, lavalink.pool_stats.wait_time / lavalink.pool_stats.queued if lavalink.pool_stats.queued else 0.0),
+        ({"stat": "max"}, lavalink.pool_stats.max_wait),
+    ]
+)
+metrics.gauge(
+    "musicbot_players", "Chat players alive",
+    lambda: [({}, len(players))]
+)
+metrics.counter_reader(
+    "musicbot_cache_events_total", "Cache hits and misses",
+    lambda: [
+        ({"cache": "search", "event": "hit"}, lavalink.search_cache.hits),
+        ({"cache": "search", "event": "miss"}, lavalink.search_cache.misses),
+        ({"cache": "prefetch", "event": "hit"}, prefetcher.hits),
+        ({"cache": "prefetch", "event": "miss"}, prefetcher.misses),
+        ({"cache": "audio", "event": "hit"}, audio_cache.hits),
+        ({"cache": "audio", "event": "miss"}, audio_cache.misses),
+    ]
+)
 
 
-async def play_next(chat_id: int):
-    """Play next song"""
-    if chat_id not in queues or not queues[chat_id]:
-        current_playing.pop(chat_id, None)
+def instrumented(command: str, handler):
+    """Wrap a command handler to record its latency and uncaught errors"""
+    async def wrapper(client, message):
+        started = time.monotonic()
         try:
-            if TGCALLS_LIB == "ntgcalls":
-                await tgcalls.leave_call(chat_id)
-            else:
-                await tgcalls.leave_group_call(chat_id)
-        except:
-            pass
+            await handler(client, message)
+        except Exception:
+            ERRORS.inc(kind="handler")
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.monotonic() - started, command=command)
+    return wrapper
+
+
+def on_stream_end(chat_id: int):
+    """Advance the queue when TgCalls reports the stream finished"""
+    ended_at = time.monotonic()
+    player = players.get(chat_id)
+    if player is None or player.current is None:
         return
+    logger.info(f"⏹ Stream ended in {chat_id}: {player.current.title}")
+    player.submit(player.stream_ended, player.current, ended_at)
+
+
+def register_stream_end_handler():
+    """Hook on_stream_end into every assistant's call engine"""
+    for assistant in assistants.assistants:
+        assistant.on_stream_end(on_stream_end)
     
-    song = queues[chat_id].pop(0)
-    current_playing[chat_id] = song
-    
-    try:
-        stream_url = await lavalink.get_stream_url(song["track"])
-        if not stream_url:
-            await play_next(chat_id)
-            return
-        
-        if TGCALLS_LIB == "ntgcalls":
-            await tgcalls.join_call(chat_id, stream_url, stream_type="audio")
-        else:
-            await tgcalls.join_group_call(chat_id, MediaStream(stream_url))
-        
-        logger.info(f"✓ Playing: {song['title']}")
-    except Exception as e:
-        logger.error(f"Play error: {e}")
-        await play_next(chat_id)
+    logger.info("✓ Stream end handler registered")
 
 
 # ============================================
@@ -191,9 +2776,13 @@ async def start_handler(client, message: Message):
             "/play <song> - Play music\n"
             "/pause - Pause\n"
             "/resume - Resume\n"
+            "/volume <0-200> - Set volume\n"
             "/skip - Skip\n"
             "/stop - Stop\n"
-            "/queue - Show queue\n"
+            "/queue [page] - Show queue\n"
+            "/shuffle - Shuffle queue\n"
+            "/remove <n> - Remove from queue\n"
+            "/move <from> <to> - Reorder queue\n"
             "/current - Current song\n"
             "/ping - Test bot\n\n"
             "**Powered by Lavalink**"
@@ -213,9 +2802,37 @@ async def ping_handler(client, message: Message):
         logger.error(f"Ping error: {e}")
 
 
+async def enqueue_playlist(
+    chat_id: int, tracks: List[dict], requester, status, headline: str, name: str, generation: int
+) -> int:
+    """Enqueue tracks[1:] in chunks after the first song's enqueue returned generation; returns songs added"""
+    total = len(tracks)
+    added = 1
+    editor.edit(status, f"{headline}\n📥 Loading **{name}**: {added}/{total}")
+    
+    for start in range(1, total, PLAYLIST_CHUNK_SIZE):
+        chunk = tracks[start:start + PLAYLIST_CHUNK_SIZE]
+        for track in chunk:
+            lavalink.remember_track(track)
+        result = await dispatch(
+            chat_id, "enqueue", [QueuedTrack.from_lavalink(track, requester).to_dict() for track in chunk], generation
+        )
+        # /stop while loading cancels the rest of the playlist
+        if result["state"] == "stopped":
+            editor.edit(status, f"{headline}\n⏹ Stopped loading **{name}** at {added}/{total}")
+            return added
+        added += len(chunk)
+        # Progress edits are coalesced, so only the latest one is sent
+        editor.edit(status, f"{headline}\n📥 Loading **{name}**: {added}/{total}")
+    
+    editor.edit(status, f"{headline}\n✅ Added {added} songs from **{name}**")
+    return added
+
+
 async def play_handler(client, message: Message):
     """Play command"""
     logger.info(f"⭐ PLAY from {message.from_user.id}: {message.text}")
+    started = time.monotonic()
     
     try:
         if len(message.command) < 2:
@@ -229,51 +2846,72 @@ async def play_handler(client, message: Message):
             await message.reply_text("❌ This works in groups only!")
             return
         
+        # A user over their own limit must not use up the chat's tokens for everyone else
+        user_id = message.from_user.id
+        wait = user_limiter.check(user_id)
+        if not wait:
+            wait = chat_limiter.check(chat_id)
+            if wait:
+                user_limiter.refund(user_id)
+        if wait:
+            REJECTED.inc(reason="rate_limit")
+            await message.reply_text(f"⏳ Slow down! Try again in {max(1, round(wait))}s")
+            return
+        
         status = await message.reply_text("🔍 Searching...")
         
-        result = await lavalink.search(query)
+        try:
+            result = await lavalink.search(query)
+        except LavalinkBusy:
+            REJECTED.inc(reason="busy")
+            editor.edit(status, "🚦 Bot is busy, try again in a moment")
+            return
         if not result or result.get("loadType") == "error":
-            await status.edit_text("❌ No results found!")
+            editor.edit(status, "❌ No results found!")
             return
         
         load_type = result.get("loadType")
+        name = "playlist"
         
         if load_type == "track":
             tracks = [result["data"]]
         elif load_type == "search":
             tracks = result["data"][:1]
         elif load_type == "playlist":
-            tracks = result["data"]["tracks"][:10]
+            tracks = result["data"]["tracks"][:PLAYLIST_MAX_TRACKS]
+            name = result["data"].get("info", {}).get("name", name)
         else:
-            await status.edit_text("❌ Could not load track!")
+            editor.edit(status, "❌ Could not load track!")
             return
         
         if not tracks:
-            await status.edit_text("❌ No tracks found!")
+            editor.edit(status, "❌ No tracks found!")
             return
         
-        if chat_id not in queues:
-            queues[chat_id] = []
+        requester = message.from_user.mention
         
-        for track in tracks:
-            info = track.get("info", {})
-            queues[chat_id].append({
-                "title": info.get("title", "Unknown"),
-                "author": info.get("author", "Unknown"),
-                "duration": info.get("length", 0),
-                "track": track.get("encoded"),
-                "requester": message.from_user.mention
-            })
+        # Enqueue the first song on its own so playback starts right away
+        lavalink.remember_track(tracks[0])
+        first = QueuedTrack.from_lavalink(tracks[0], requester)
+        enqueued = await dispatch(chat_id, "enqueue", [first.to_dict()])
+        state = enqueued["state"]
+        if state == "playing":
+            FIRST_AUDIO_SECONDS.observe(time.monotonic() - started)
+        if state == "queued":
+            headline = f"✅ Added: **{first.title}**"
+        else:
+            headline = f"▶️ Playing: **{first.title}**"
         
-        if chat_id not in current_playing:
-            await status.edit_text(f"▶️ Playing: **{tracks[0]['info']['title']}**")
-            await play_next(chat_id)
+        if len(tracks) > 1:
+            added = await enqueue_playlist(chat_id, tracks, requester, status, headline, name, enqueued["generation"])
         else:
-            await status.edit_text(f"✅ Added: **{tracks[0]['info']['title']}**")
+            added = 1
+            editor.edit(status, headline)
         
-        logger.info(f"✓ Added {len(tracks)} track(s)")
+        logger.info(f"✓ Added {added} track(s)")
         
     except Exception as e:
+        ERRORS.inc(kind="handler")
         logger.error(f"Play error: {e}", exc_info=True)
         await message.reply_text(f"❌ Error: {e}")
 
@@ -281,17 +2919,11 @@ async def play_handler(client, message: Message):
 async def pause_handler(client, message: Message):
     """Pause command"""
     logger.info(f"⭐ PAUSE from {message.from_user.id}")
-    chat_id = message.chat.id
-    
-    if chat_id not in current_playing:
-        await message.reply_text("❌ Nothing playing!")
-        return
     
     try:
-        if TGCALLS_LIB == "ntgcalls":
-            await tgcalls.pause(chat_id)
-        else:
-            await tgcalls.pause_stream(chat_id)
+        if not await dispatch(message.chat.id, "pause"):
+            await message.reply_text("❌ Nothing playing!")
+            return
         await message.reply_text("⏸ Paused")
     except Exception as e:
         await message.reply_text(f"❌ Error: {e}")
@@ -300,161 +2932,389 @@ async def pause_handler(client, message: Message):
 async def resume_handler(client, message: Message):
     """Resume command"""
     logger.info(f"⭐ RESUME from {message.from_user.id}")
-    chat_id = message.chat.id
-    
-    if chat_id not in current_playing:
-        await message.reply_text("❌ Nothing playing!")
-        return
     
     try:
-        if TGCALLS_LIB == "ntgcalls":
-            await tgcalls.resume(chat_id)
-        else:
-            await tgcalls.resume_stream(chat_id)
+        if not await dispatch(message.chat.id, "resume"):
+            await message.reply_text("❌ Nothing playing!")
+            return
         await message.reply_text("▶️ Resumed")
     except Exception as e:
         await message.reply_text(f"❌ Error: {e}")
 
 
+async def volume_handler(client, message: Message):
+    """Volume command"""
+    logger.info(f"⭐ VOLUME from {message.from_user.id}: {message.text}")
+    
+    if len(message.command) < 2 or not message.command[1].isdigit() or int(message.command[1]) > 200:
+        await message.reply_text("❌ Usage: /volume <0-200>")
+        return
+    
+    level = int(message.command[1])
+    if await dispatch(message.chat.id, "volume", level / 100):
+        await message.reply_text(f"🔊 Volume: {level}%")
+    else:
+        note = "from the next song" if FRAME_BROADCAST else "to songs played from the audio cache"
+        await message.reply_text(f"🔊 Volume: {level}% (applies {note})")
+
+
 async def skip_handler(client, message: Message):
     """Skip command"""
     logger.info(f"⭐ SKIP from {message.from_user.id}")
-    chat_id = message.chat.id
     
-    if chat_id not in current_playing:
+    if not await dispatch(message.chat.id, "skip"):
         await message.reply_text("❌ Nothing playing!")
         return
     
     await message.reply_text("⏭ Skipped")
-    await play_next(chat_id)
 
 
 async def stop_handler(client, message: Message):
     """Stop command"""
     logger.info(f"⭐ STOP from {message.from_user.id}")
-    chat_id = message.chat.id
-    
-    if chat_id not in current_playing:
-        await message.reply_text("❌ Nothing playing!")
-        return
-    
-    queues.pop(chat_id, None)
-    current_playing.pop(chat_id, None)
     
     try:
-        if TGCALLS_LIB == "ntgcalls":
-            await tgcalls.leave_call(chat_id)
-        else:
-            await tgcalls.leave_group_call(chat_id)
+        if not await dispatch(message.chat.id, "stop"):
+            await message.reply_text("❌ Nothing playing!")
+            return
         await message.reply_text("⏹ Stopped")
     except Exception as e:
         await message.reply_text(f"❌ Error: {e}")
 
 
+def queue_markup(buttons: list) -> Optional[InlineKeyboardMarkup]:
+    if not buttons:
+        return None
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=data) for label, data in buttons]])
+
+
 async def queue_handler(client, message: Message):
     """Queue command"""
-    chat_id = message.chat.id
+    page = int(message.command[1]) - 1 if len(message.command) > 1 and message.command[1].isdigit() else 0
+    rendered = await dispatch(message.chat.id, "queue_page", page)
     
-    if chat_id not in queues or not queues[chat_id]:
+    if not rendered:
         await message.reply_text("📭 Queue is empty")
         return
     
-    text = "📜 **Queue:**\n\n"
-    for i, song in enumerate(queues[chat_id][:10], 1):
-        dur = song["duration"] // 1000
-        text += f"{i}. **{song['title']}**\n   {song['author']} | {dur//60}:{dur%60:02d}\n\n"
+    text, buttons = rendered
+    await message.reply_text(text, reply_markup=queue_markup(buttons))
+
+
+async def queue_page_callback(client, query: CallbackQuery):
+    """Queue page buttons"""
+    rendered = await dispatch(query.message.chat.id, "queue_page", int(query.data.split(":", 1)[1]))
+    
+    if not rendered:
+        editor.edit(query.message, "📭 Queue is empty")
+    else:
+        text, buttons = rendered
+        editor.edit(query.message, text, reply_markup=queue_markup(buttons))
+    await query.answer()
+
+
+async def shuffle_handler(client, message: Message):
+    """Shuffle command"""
+    logger.info(f"⭐ SHUFFLE from {message.from_user.id}")
+    
+    if not await dispatch(message.chat.id, "shuffle"):
+        await message.reply_text("❌ Not enough songs to shuffle!")
+        return
+    
+    await message.reply_text("🔀 Queue shuffled")
+
+
+async def remove_handler(client, message: Message):
+    """Remove command"""
+    logger.info(f"⭐ REMOVE from {message.from_user.id}: {message.text}")
+    
+    if len(message.command) < 2 or not message.command[1].isdigit():
+        await message.reply_text("❌ Usage: /remove <position>")
+        return
+    
+    song = await dispatch(message.chat.id, "remove", int(message.command[1]) - 1)
+    if not song:
+        await message.reply_text("❌ No song at that position!")
+        return
+    
+    await message.reply_text(f"🗑 Removed: **{song['title']}**")
+
+
+async def move_handler(client, message: Message):
+    """Move command"""
+    logger.info(f"⭐ MOVE from {message.from_user.id}: {message.text}")
+    
+    if len(message.command) < 3 or not (message.command[1].isdigit() and message.command[2].isdigit()):
+        await message.reply_text("❌ Usage: /move <from> <to>")
+        return
     
-    if len(queues[chat_id]) > 10:
-        text += f"...and {len(queues[chat_id]) - 10} more"
+    src, dst = int(message.command[1]) - 1, int(message.command[2]) - 1
+    song = await dispatch(message.chat.id, "move", src, dst)
+    if not song:
+        await message.reply_text("❌ No song at that position!")
+        return
     
-    await message.reply_text(text)
+    await message.reply_text(f"↕️ Moved **{song['title']}** to position {dst + 1}")
 
 
 async def current_handler(client, message: Message):
     """Current command"""
-    chat_id = message.chat.id
+    playing = await dispatch(message.chat.id, "now_playing")
     
-    if chat_id not in current_playing:
+    if not playing:
         await message.reply_text("❌ Nothing playing!")
         return
     
-    song = current_playing[chat_id]
-    dur = song["duration"] // 1000
+    song = playing["song"]
     
     await message.reply_text(
         f"🎵 **Now Playing:**\n\n"
         f"**{song['title']}**\n"
         f"👤 {song['author']}\n"
-        f"⏱ {dur//60}:{dur%60:02d}\n"
-        f"👤 By: {song['requester']}"
+        f"⏱ {format_duration(song['duration'])}\n"
+        f"👤 By: {song['requester']}\n"
+        f"📜 Up next: {playing['upcoming']} songs ({format_duration(playing['upcoming_duration'])})"
+    )
+
+
+IMPORT_SECONDS = time.monotonic() - STARTED
+
+
+async def start_clients():
+    """Start the call engines and Telegram clients"""
+    if any(not assistant.owns_client for assistant in assistants.assistants):
+        # TgCalls on the main client has always started before the client itself
+        await assistants.start()
+        await app.start()
+    else:
+        await asyncio.gather(assistants.start(), app.start())
+
+
+async def start_metrics():
+    if not METRICS_PORT:
+        return
+    try:
+        await metrics.start(METRICS_HOST, METRICS_PORT)
+    except OSError as e:
+        # e.g. the port is still held by the instance being replaced
+        logger.warning(f"⚠ Metrics endpoint not started on {METRICS_HOST}:{METRICS_PORT}: {e}")
+
+
+async def warm_up(searches: bool, hot: bool):
+    """Prime Lavalink connections and caches before the first command arrives"""
+    started = time.monotonic()
+    hot_count = 0
+    if hot:
+        hot_count = hot_tracks.load()
+        for song in hot_tracks.hottest():
+            # Their stream URLs then resolve without /v4/decodetrack
+            lavalink.remember_track({
+                "encoded": song.track,
+                "info": {
+                    "title": song.title,
+                    "author": song.author,
+                    "length": song.duration,
+                    "uri": song.uri,
+                    "identifier": song.identifier,
+                },
+            })
+        prefetcher.prefetch(song for song in hot_tracks.hottest(HOT_TRACKS_PREFETCH) if song not in audio_cache)
+    
+    queries = WARMUP_QUERIES if searches else []
+    try:
+        connections, *results = await asyncio.wait_for(
+            asyncio.gather(
+                lavalink.preconnect(WARMUP_CONNECTIONS),
+                # Also warms Lavalink's JIT and the YouTube path behind it
+                *(lavalink.search(query) for query in queries),
+                return_exceptions=True
+            ),
+            WARMUP_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"⚠ Warm-up cut short after {WARMUP_TIMEOUT}s")
+        return
+    logger.info(
+        f"✓ Warm-up in {(time.monotonic() - started) * 1000:.0f} ms: "
+        f"{connections if isinstance(connections, int) else 0} connections, "
+        f"{sum(bool(r) and not isinstance(r, Exception) for r in results)}/{len(queries)} searches, "
+        f"{hot_count} hot tracks"
+    )
+
+
+def warm_imports():
+    """Import what the first songs will need in a thread, after the bot is ready"""
+    if YT_DLP_AVAILABLE and PREFETCH_EXTRACT:
+        asyncio.get_running_loop().run_in_executor(None, importlib.import_module, "yt_dlp")
+
+
+def log_ready(name: str):
+    logger.info(
+        f"✅ {name} IS READY! in {(time.monotonic() - STARTED) * 1000:.0f} ms "
+        f"(imports {IMPORT_SECONDS * 1000:.0f} ms)"
     )
 
 
 async def main():
     """Main function"""
+    global supervisor
     logger.info("Initializing...")
     
-    # Initialize Lavalink
+    if WORKERS and len(ASSISTANT_SESSIONS) < WORKERS:
+        logger.error(f"❌ WORKERS = {WORKERS} needs at least as many ASSISTANT_SESSIONS")
+        return
+    
+    load_client_libraries()
+    build_clients()
+    partition_journals()
     await lavalink.initialize()
     
-    # Test Lavalink
-    try:
-        async with lavalink.session.get(f"{lavalink.base_url}/version", headers=lavalink.headers) as resp:
-            if resp.status == 200:
-                version = await resp.text()
-                logger.info(f"✓ Lavalink: {version}")
-            else:
-                logger.error("❌ Can't connect to Lavalink!")
-                await lavalink.close()
-                return
-    except Exception as e:
-        logger.error(f"❌ Lavalink error: {e}")
+    if WORKERS:
+        # Voice chats, queues and the journal live in the worker processes
+        supervisor = WorkerSupervisor(WORKERS)
+        supervisor.start()
+        logger.info(f"✓ Started {WORKERS} workers")
+    else:
+        audio_cache.load()
+    
+    async def lavalink_ready() -> int:
+        nodes = await lavalink.check_nodes()
+        if nodes:
+            await warm_up(searches=True, hot=not WORKERS)
+        return nodes
+    
+    # Test and warm up Lavalink, start the metrics endpoint and log in, all at once.
+    # The clients go last, so Lavalink is already connecting while TgCalls imports.
+    nodes, _, _ = await asyncio.gather(lavalink_ready(), start_metrics(), start_clients())
+    if not nodes:
+        logger.error("❌ Can't connect to Lavalink!")
         logger.error("Start Lavalink first: cd lavalink && java -jar Lavalink.jar")
+        if supervisor is not None:
+            await supervisor.stop()
+        await assistants.stop()
+        await app.stop()
         await lavalink.close()
+        await metrics.stop()
         return
     
-    # Start PyTgCalls if needed
-    if TGCALLS_LIB != "ntgcalls":
-        await tgcalls.start()
-    
-    # Start Pyrogram
-    await app.start()
-    
-    me = await app.get_me()
+    me = getattr(app, "me", None) or await app.get_me()
     logger.info(f"✓ Logged in as: {me.first_name} (@{me.username})")
     
+    # Bring back queues from before the restart; calls are rejoined once handlers are up
+    restored = []
+    if not WORKERS:
+        register_stream_end_handler()
+        restored = restore_players()
+    
     # ============================================
     # REGISTER HANDLERS AFTER START (KEY FIX!)
     # ============================================
     logger.info("Registering command handlers...")
     
-    app.add_handler(MessageHandler(start_handler, filters.command("start")))
-    app.add_handler(MessageHandler(ping_handler, filters.command("ping")))
-    app.add_handler(MessageHandler(play_handler, filters.command("play")))
-    app.add_handler(MessageHandler(pause_handler, filters.command("pause")))
-    app.add_handler(MessageHandler(resume_handler, filters.command("resume")))
-    app.add_handler(MessageHandler(skip_handler, filters.command("skip")))
-    app.add_handler(MessageHandler(stop_handler, filters.command("stop")))
-    app.add_handler(MessageHandler(queue_handler, filters.command("queue")))
-    app.add_handler(MessageHandler(current_handler, filters.command("current")))
+    app.add_handler(MessageHandler(instrumented("start", start_handler), filters.command("start")))
+    app.add_handler(MessageHandler(instrumented("ping", ping_handler), filters.command("ping")))
+    app.add_handler(MessageHandler(instrumented("play", play_handler), filters.command("play")))
+    app.add_handler(MessageHandler(instrumented("pause", pause_handler), filters.command("pause")))
+    app.add_handler(MessageHandler(instrumented("resume", resume_handler), filters.command("resume")))
+    app.add_handler(MessageHandler(instrumented("volume", volume_handler), filters.command("volume")))
+    app.add_handler(MessageHandler(instrumented("skip", skip_handler), filters.command("skip")))
+    app.add_handler(MessageHandler(instrumented("stop", stop_handler), filters.command("stop")))
+    app.add_handler(MessageHandler(instrumented("queue", queue_handler), filters.command("queue")))
+    app.add_handler(MessageHandler(instrumented("shuffle", shuffle_handler), filters.command("shuffle")))
+    app.add_handler(MessageHandler(instrumented("remove", remove_handler), filters.command("remove")))
+    app.add_handler(MessageHandler(instrumented("move", move_handler), filters.command("move")))
+    app.add_handler(MessageHandler(instrumented("current", current_handler), filters.command("current")))
+    app.add_handler(CallbackQueryHandler(instrumented("queue_page", queue_page_callback), filters.regex(r"^queue:\d+$")))
     
     logger.info("✓ All handlers registered!")
     logger.info("="*60)
-    logger.info("✅ BOT IS READY!")
+    log_ready("BOT")
     logger.info("Try: /start or /ping")
     logger.info("="*60)
     
+    rejoining = asyncio.create_task(rejoin_players(restored))
+    if not WORKERS:
+        warm_imports()
+    
     # Keep alive
     from pyrogram import idle
     await idle()
     
     # Cleanup
+    logger.info(f"Search cache: {lavalink.search_cache.stats()}")
+    logger.info(f"Prefetch: {prefetcher.stats()}")
+    logger.info(f"Audio cache: {audio_cache.stats()}")
+    logger.info(f"Frame pump: {frame_pump.stats()}")
+    logger.info(f"Lavalink: {lavalink.stats()}")
+    logger.info(f"Edits: {editor.stats()}")
+    logger.info(f"Assistants: {assistants.stats()}")
+    rejoining.cancel()
+    if not WORKERS:
+        hot_tracks.save()
+    if supervisor is not None:
+        await supervisor.stop()
+    await assistants.stop()
     await app.stop()
     await lavalink.close()
+    await metrics.stop()
+    journal.close()
+
+
+async def worker_main():
+    """Worker process: owns a partition of chats and serves the front process"""
+    global worker_server
+    logger.info(f"Initializing worker {WORKER_INDEX + 1}/{WORKERS}...")
+    
+    load_client_libraries()
+    build_clients()
+    await lavalink.initialize()
+    audio_cache.load()
+    
+    async def lavalink_ready() -> int:
+        nodes = await lavalink.check_nodes()
+        if nodes:
+            await warm_up(searches=False, hot=True)
+        return nodes
+    
+    nodes, _, _ = await asyncio.gather(lavalink_ready(), start_metrics(), assistants.start())
+    if not nodes:
+        logger.error("❌ Can't connect to Lavalink!")
+        await assistants.stop()
+        await lavalink.close()
+        await metrics.stop()
+        return
+    register_stream_end_handler()
+    
+    # Notifications from restored chats wait until the front connects
+    worker_server = WorkerServer(worker_socket(WORKER_INDEX))
+    restored = restore_players()
+    await worker_server.start()
+    log_ready(f"WORKER {WORKER_INDEX}")
+    rejoining = asyncio.create_task(rejoin_players(restored))
+    warm_imports()
+    
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stopping.set)
+    await stopping.wait()
+    
+    # Cleanup
+    logger.info(f"Worker {WORKER_INDEX} lavalink: {lavalink.stats()}")
+    logger.info(f"Worker {WORKER_INDEX} audio cache: {audio_cache.stats()}")
+    logger.info(f"Worker {WORKER_INDEX} frame pump: {frame_pump.stats()}")
+    logger.info(f"Worker {WORKER_INDEX} assistants: {assistants.stats()}")
+    rejoining.cancel()
+    hot_tracks.save()
+    await worker_server.stop()
+    await assistants.stop()
+    await lavalink.close()
+    await metrics.stop()
+    journal.close()
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        asyncio.run(worker_main() if WORKER_INDEX is not None else main())
     except KeyboardInterrupt:
         logger.info("\n✓ Bot stopped")